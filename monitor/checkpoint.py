@@ -0,0 +1,130 @@
+import os
+import re
+import time
+import json
+import shutil
+import hashlib
+import logging
+import cPickle as pickle
+from nupic.frameworks.opf.modelfactory import ModelFactory
+
+logger = logging.getLogger(__name__)
+
+# Layout of a checkpoint directory:
+#   <checkpoint_dir>/<stream_id>/<timestamp>/model/      OPF model (model.save)
+#   <checkpoint_dir>/<stream_id>/<timestamp>/state.pkl   everything else
+# A checkpoint is only valid once state.pkl exists, as it is written last.
+MODEL_DIR = 'model'
+STATE_FILE = 'state.pkl'
+STATE_VERSION = 1
+
+def params_digest(model_params):
+    """ Return a digest of NuPIC model params, to tell if they changed. """
+
+    return hashlib.md5(json.dumps(model_params, sort_keys=True, default=repr)).hexdigest()
+
+class Checkpointer(object):
+    """ Save and restore timestamped checkpoints of a monitor. If params (a
+        params_digest) is given, it's saved with checkpoints, and checkpoints
+        saved with other params are skipped, as their model ignores them.
+    """
+
+    def __init__(self, checkpoint_dir, stream_id, keep=2, params=None):
+        # Stream ids are used as directory names, so strip anything odd
+        safe_id = re.sub(r'[^\w.-]', '_', str(stream_id))
+        self.path = os.path.join(checkpoint_dir, safe_id)
+        self.keep = keep
+        self.params = params
+
+    def save(self, model, state):
+        """ Save model and state dict to a new checkpoint. """
+
+        name = '%d' % (time.time() * 1000)
+        tmp_path = os.path.join(self.path, '.%s.tmp' % name)
+        final_path = os.path.join(self.path, name)
+
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        model.save(os.path.abspath(os.path.join(tmp_path, MODEL_DIR)))
+
+        state['version'] = STATE_VERSION
+        state['params'] = self.params
+        with open(os.path.join(tmp_path, STATE_FILE), 'wb') as state_file:
+            pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+
+        # Rename is atomic, so a crash never leaves a half written checkpoint
+        os.rename(tmp_path, final_path)
+        self._prune()
+
+        return final_path
+
+    def load(self):
+        """ Return (model, state) from the latest valid checkpoint, or None. """
+
+        for name in reversed(self._checkpoints()):
+            path = os.path.join(self.path, name)
+            try:
+                with open(os.path.join(path, STATE_FILE), 'rb') as state_file:
+                    state = pickle.load(state_file)
+                if state.get('version') != STATE_VERSION:
+                    logger.warn("Skipping checkpoint %s with version %s.", path, state.get('version'))
+                    continue
+                if not self._same_params(state, path):
+                    continue
+                model = ModelFactory.loadFromCheckpoint(os.path.abspath(os.path.join(path, MODEL_DIR)))
+            except Exception:
+                logger.warn("Skipping invalid checkpoint %s.", path, exc_info=True)
+                continue
+            logger.info("Restored checkpoint %s.", path)
+            return model, state
+
+        return None
+
+    def load_state(self):
+        """ Return the state dict from the latest valid checkpoint (without
+            loading its model), or None.
+        """
+        for name in reversed(self._checkpoints()):
+            path = os.path.join(self.path, name)
+            try:
+                with open(os.path.join(path, STATE_FILE), 'rb') as state_file:
+                    state = pickle.load(state_file)
+            except Exception:
+                logger.warn("Skipping invalid checkpoint %s.", path, exc_info=True)
+                continue
+            if state.get('version') == STATE_VERSION and self._same_params(state, path):
+                return state
+
+        return None
+
+    def _same_params(self, state, path):
+        """ Return whether the checkpoint at path was saved with self.params.
+            Checkpoints from before params were saved can't be told, so they
+            are taken as the same.
+        """
+        if self.params is None or state.get('params') in (None, self.params):
+            return True
+        logger.warn("Skipping checkpoint %s with other model params.", path)
+        return False
+
+    def delete(self):
+        """ Remove every checkpoint for this stream. """
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def _checkpoints(self):
+        """ Names of finished checkpoints, oldest first. """
+
+        if not os.path.isdir(self.path):
+            return []
+        names = [n for n in os.listdir(self.path) if n.isdigit()]
+        return sorted(names, key=int)
+
+    def _prune(self):
+        """ Keep only the most recent self.keep checkpoints. """
+
+        for name in self._checkpoints()[:-self.keep]:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -17,12 +17,64 @@ parameters:
     # Time sleep between requests when it's in online learning
     seconds_per_request: 60
 
+    # Data used for training: the last training_window seconds or the last
+    # training_rows points (if neither is set, the last 1000 results). Pages of
+    # training data are fetched with at most backfill_concurrency requests at once.
+    # training_window: 259200
+    training_rows: 1000
+    backfill_concurrency: 4
+
+    # Results of training are written to Redis at once when it finishes (only
+    # the last 10000, as for any results). Set to false to not write them.
+    training_results: true
+
+    # Requests per minute allowed to the API, shared by every monitor using the
+    # same account (through Redis). Up to rate_limit_burst requests can be made
+    # at once. Requests over the limit wait for it.
+    rate_limit: 60
+    rate_limit_burst: 10
+
+    # Seconds between checkpoints of the model (saved to CHECKPOINT_DIR, if set)
+    checkpoint_interval: 3600
+
+    # Results are written to Redis in batches of this many rows, or at least
+    # every result_flush_interval seconds
+    result_batch_size: 100
+    result_flush_interval: 1
+
+    # Format of the results saved to Redis: csv or binary (compact fixed width
+    # records, faster to read by the API). Both formats can be mixed.
+    result_format: csv
+
+    # How results are kept in Redis: sorted_set (indexed by time, so the API can
+    # query time ranges) or list (less memory, only the last N can be queried).
+    # Lists are converted when switching to sorted_set.
+    result_storage: sorted_set
+
+    # Besides the last 10000 results, we keep rollups (min, max and mean) per
+    # 5 minutes, 1 hour and 1 day. Days to keep each of them:
+    rollup_retention_days:
+        300: 30
+        3600: 365
+        86400: 1825
+
     # How many points to use for data smoothing when doing averaging
     moving_average_window: 1
 
     # Factor to multiply each data value when using scale transform
     scaling_factor: 1
 
+    # Instead of moving_average_window and scaling_factor, a list of transforms
+    # applied in order to each value (see monitor/transforms.py). E.g.:
+    # transforms:
+    #     - clip: [0, 30000]        # Limit to [min, max] (either can be null)
+    #     - rolling_median: 5       # Median of the last 5 values
+    #     - ewma: 0.3               # Exponentially weighted mean, alpha 0.3
+    #     - moving_average: 10      # Mean of the last 10 values
+    #     - rate                    # Change per second
+    #     - log                     # log(1 + value)
+    #     - scale: 0.001            # Multiply by a factor
+
     # Thresholds that triggers a POST to the webhook (if supplied)
     likelihood_threshold: None
     anomaly_threshold: None
@@ -35,6 +87,15 @@ nupic_model_params:
     tpParams:
         activationThreshold: 16
 
+# [Optional] Redis server where results are saved. Each key given overrides
+# the REDIS_HOST, REDIS_PORT or REDIS_DB environment variable (which default to
+# localhost:6379 and db 0). The API server only reads the environment, so only
+# set these if results are read from elsewhere.
+# redis:
+#     host: localhost
+#     port: 6379
+#     db: 0
+
 # [Optional ] Domain and protocol in which you'll be running the service.
 # This will be used to create links to anomalous monitors when reporting anomalies.
 # If not specified we'll use "localhost" as domain and "http" as protocol.
@@ -61,6 +122,19 @@ protocol: http
 #}
 webhook: http://localhost/listening
 
+# [Optional] Instead of posting each anomaly as soon as it happens, collect the
+# anomalies of every monitor (of every configuration file) posting to the same
+# webhook and channel during this many seconds, and post them all at once:
+#
+#{
+#    "sent_at": "2014-09-04T14:43:00.560047",
+#    "window": 60,
+#    "reports": [{"monitor": ..., "source": ..., "metric": ..., "chart": ..., "report": ...}, ...]
+#}
+#
+# Slack webhooks get one message with an attachment per anomalous monitor.
+# digest_window: 60
+
 # [Optional] A Slack channel. If the webhook above is a Slack webhook we will
 # post the anomalies to channel specified here. It defaults to the default channel
 # of the Slack webhook and is not used if the webhook is not from Slack.
@@ -0,0 +1,40 @@
+import struct
+
+# Rows saved in 'results:<stream_id>' are tuples:
+#   (timestamp, raw_value, actual, predicted, anomaly, likelihood)
+# and can be stored in one of two formats:
+# * csv: '%s,%.5f,%.5f,%.5f,%.5f,%.5f' string (the default, ~60 bytes per row).
+# * binary: fixed width record of 37 bytes, little endian:
+#     magic byte 0x01, uint32 timestamp, float64 raw_value, actual and
+#     predicted, float32 anomaly and likelihood.
+# Both can live in the same list, so switching formats needs no migration.
+BINARY_MAGIC = '\x01'
+BINARY_RECORD = struct.Struct('<cIdddff')
+
+def encode_csv(row):
+    """ Encode a result row as a CSV string. """
+
+    return '%s,%.5f,%.5f,%.5f,%.5f,%.5f' % row
+
+def encode_binary(row):
+    """ Encode a result row as a fixed width binary record. """
+
+    return BINARY_RECORD.pack(BINARY_MAGIC, int(row[0]), *row[1:])
+
+def decode(value):
+    """ Decode a result row stored in any format. """
+
+    if len(value) == BINARY_RECORD.size and value[0] == BINARY_MAGIC:
+        return BINARY_RECORD.unpack(value)[1:]
+
+    fields = value.split(',')
+    return (int(fields[0]),) + tuple(float(f) for f in fields[1:])
+
+ENCODERS = {'csv': encode_csv, 'binary': encode_binary}
+
+def get_encoder(result_format):
+    """ Return the encoder for result_format ('csv' or 'binary'). """
+
+    if result_format not in ENCODERS:
+        raise ValueError('Unknown result format: %s' % result_format)
+    return ENCODERS[result_format]
@@ -0,0 +1,112 @@
+import Queue
+import logging
+import threading
+from time import time, sleep
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class IngestQueues(object):
+    """ Bounded queues of pushed points per check, drained by worker threads
+        that feed them with process(check_id, points, config) (points as
+        [(timestamp, value), ...], in the order queued), so that receiving
+        points doesn't wait for the models. Each check is processed by one
+        worker at a time, keeping its points in order.
+    """
+
+    def __init__(self, process, size=1000, workers=4):
+        self.process = process
+        self.size = size
+        self._queues = {}   # check_id -> deque of (timestamp, value)
+        self._configs = {}  # check_id -> config of the first queued point
+        self._results = {}  # check_id -> last result
+        self._scheduled = set() # checks waiting for or held by a worker
+        self._ready = Queue.Queue()
+        self._lock = threading.Lock()
+
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def put(self, check_id, points, config=None):
+        """ Queue points of check_id, all or none. Return the depth of its
+            queue, or None if it has no room for them.
+        """
+        with self._lock:
+            queue = self._queues.get(check_id, ())
+            if len(queue) + len(points) > self.size:
+                return None
+            self._queues.setdefault(check_id, deque()).extend(points)
+            if config and check_id not in self._configs:
+                self._configs[check_id] = config
+            if check_id not in self._scheduled:
+                self._scheduled.add(check_id)
+                self._ready.put(check_id)
+            return len(self._queues[check_id])
+
+    def depth(self, check_id):
+        """ Return the number of points queued for check_id. """
+
+        with self._lock:
+            return len(self._queues.get(check_id, ()))
+
+    def depths(self):
+        """ Return dict of the number of points queued per check. """
+
+        with self._lock:
+            return dict((check_id, len(queue)) for check_id, queue in self._queues.iteritems())
+
+    def last_result(self, check_id):
+        """ Return the result of the last point processed for check_id, or None. """
+
+        with self._lock:
+            return self._results.get(check_id)
+
+    def forget(self, check_id):
+        """ Drop the queued points and last result of check_id. """
+
+        with self._lock:
+            queue = self._queues.get(check_id)
+            if queue is not None:
+                queue.clear()
+            self._configs.pop(check_id, None)
+            self._results.pop(check_id, None)
+
+    def wait(self, timeout=None):
+        """ Wait until every queued point is processed (or timeout seconds).
+            Return whether they were.
+        """
+        start = time()
+        while True:
+            with self._lock:
+                if not self._scheduled:
+                    return True
+            if timeout is not None and time() - start > timeout:
+                return False
+            sleep(0.1)
+
+    def _work(self):
+        while True:
+            check_id = self._ready.get()
+            with self._lock:
+                points = list(self._queues.get(check_id, ()))
+                self._queues.get(check_id, deque()).clear()
+                config = self._configs.pop(check_id, None)
+
+            results = []
+            if points:
+                try:
+                    results = self.process(check_id, points, config)
+                except Exception:
+                    logger.warn("Could not process %d points of %s.", len(points), check_id, exc_info=True)
+
+            with self._lock:
+                if results:
+                    self._results[check_id] = results[-1]
+                if self._queues.get(check_id):
+                    # More points came meanwhile
+                    self._ready.put(check_id)
+                else:
+                    self._queues.pop(check_id, None)
+                    self._scheduled.discard(check_id)
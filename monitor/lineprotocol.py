@@ -0,0 +1,121 @@
+import math
+import socket
+import logging
+import threading
+import SocketServer
+from time import time, sleep
+
+logger = logging.getLogger(__name__)
+
+def parse_line(line, now=None):
+    """ Return (check_id, timestamp, value) from a line in one of:
+            <check_id> <value> [<timestamp>]     (Graphite plaintext)
+            <check_id>:<value>|g                 (statsd gauge)
+        Timestamps default to now. Return None if the line is invalid (or its
+        value is not finite).
+    """
+    line = line.strip()
+    if not line:
+        return None
+    point = None
+    try:
+        if ':' in line and '|' in line:
+            check_id, rest = line.rsplit(':', 1)
+            value, kind = rest.split('|', 1)
+            if kind.split('|')[0] != 'g':
+                return None
+            point = check_id, int(now or time()), float(value)
+        else:
+            fields = line.split()
+            if len(fields) == 2:
+                point = fields[0], int(now or time()), float(fields[1])
+            elif len(fields) == 3:
+                point = fields[0], int(float(fields[2])), float(fields[1])
+    except (ValueError, OverflowError):
+        return None
+    if point is None or math.isnan(point[2]) or math.isinf(point[2]):
+        return None
+    return point
+
+class LineBuffer(object):
+    """ Buffer points per check and feed them with push_many(check_id, points)
+        (points as [(timestamp, value), ...], in time order) every
+        flush_interval seconds, so receiving a point costs only parsing it.
+        At most max_points are buffered: more are dropped (and counted).
+    """
+
+    def __init__(self, push_many, flush_interval=1, max_points=100000):
+        self.push_many = push_many
+        self.flush_interval = flush_interval
+        self.max_points = max_points
+        self.stats = {'received': 0, 'invalid': 0, 'dropped': 0}
+        self._points = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        flusher = threading.Thread(target=self._flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def add_line(self, line):
+        point = parse_line(line)
+        with self._lock:
+            if point is None:
+                self.stats['invalid'] += 1
+                return
+            if self._size >= self.max_points:
+                self.stats['dropped'] += 1
+                return
+            check_id, timestamp, value = point
+            self._points.setdefault(check_id, []).append((timestamp, value))
+            self._size += 1
+            self.stats['received'] += 1
+
+    def flush(self):
+        with self._lock:
+            points, self._points = self._points, {}
+            self._size = 0
+        for check_id, check_points in points.iteritems():
+            check_points.sort(key=lambda point: point[0])
+            try:
+                self.push_many(check_id, check_points)
+            except Exception:
+                logger.warn("Could not process %d points of %s.", len(check_points), check_id, exc_info=True)
+
+    def _flush_loop(self):
+        while True:
+            sleep(self.flush_interval)
+            self.flush()
+
+class _UDPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        data = self.request[0]
+        for line in data.splitlines():
+            self.server.buffer.add_line(line)
+
+class _TCPHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            self.server.buffer.add_line(line)
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_listeners(port, buffer, host=''):
+    """ Listen for lines on UDP and TCP port (in background threads), adding
+        them to buffer (a LineBuffer). Return the servers.
+    """
+    # Datagrams are handled in a single thread, as handling them is cheap
+    udp = SocketServer.UDPServer((host, port), _UDPHandler)
+    udp.max_packet_size = 65535
+    udp.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+    tcp = _TCPServer((host, port), _TCPHandler)
+
+    for server in (udp, tcp):
+        server.buffer = buffer
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    logger.info("Listening for line protocol on UDP and TCP port %d", port)
+    return udp, tcp
@@ -1,16 +1,17 @@
-import redis
 import logging
 import logging.handlers
 from nupic.frameworks.opf.modelfactory import ModelFactory
 from nupic.data.inference_shifter import InferenceShifter
 import base_model_params # file containing CLA parameters
 from nupic.algorithms.anomaly_likelihood import AnomalyLikelihood
-from time import strftime, sleep
-from datetime import datetime
+from checkpoint import Checkpointer, params_digest
+from results import get_redis, get_result_sink
+from rollups import Rollups
+from webhooks import get_dispatcher, get_digest, build_payload
+from time import strftime, sleep, time
 import calendar
+import copy
 import os
-import requests
-import json
 import collections
 
 def update_dict(d, u):
@@ -25,46 +26,85 @@ def update_dict(d, u):
 
 logger = logging.getLogger(__name__)
 
-class Monitor(object):
-    """ A NuPIC model that saves results to Redis. """
-
-    def __init__(self, config):
+def build_model_params(config):
+    """ Return the NuPIC model params for a monitor config. """
 
-        # Instantiate NuPIC model
-        model_params = base_model_params.MODEL_PARAMS
+    # Copy params, as a process may host many models
+    model_params = copy.deepcopy(base_model_params.MODEL_PARAMS)
 
-        # Set resolution
-        model_params['modelParams']['sensorParams']['encoders']['value']['resolution'] = config['resolution']
+    # Set resolution
+    model_params['modelParams']['sensorParams']['encoders']['value']['resolution'] = config['resolution']
 
-        # Override other Nupic parameters:
-        model_params['modelParams'] = update_dict(model_params['modelParams'], config['nupic_model_params'])
+    # Override other Nupic parameters:
+    model_params['modelParams'] = update_dict(model_params['modelParams'], config['nupic_model_params'])
+    return model_params
 
-        # Create model and enable inference on it
-        self.model = ModelFactory.create(model_params)
-        self.model.enableInference({'predictedField': 'value'})
+class Monitor(object):
+    """ A NuPIC model that saves results to Redis. """
 
-        # The shifter is used to bring the predictions to the actual time frame
-        self.shifter = InferenceShifter()
+    def __init__(self, config):
 
-        # The anomaly likelihood object
-        self.anomalyLikelihood = AnomalyLikelihood()
+        # Instantiate NuPIC model
+        model_params = build_model_params(config)
 
         # Set stream source
         self.stream = config['stream']
 
+        # Checkpoints are disabled if no directory is given (checkpoints of
+        # other model params are not restored, so that changes take effect)
+        self.checkpointer = None
+        if config.get('checkpoint_dir'):
+            self.checkpointer = Checkpointer(config['checkpoint_dir'], self.stream.id,
+                                             params=params_digest(model_params))
+        self.checkpoint_interval = config.get('checkpoint_interval', 3600)
+        self.last_checkpoint = time()
+        self.alert = False # Toogle when we get above threshold
+        self.rollups = Rollups()
+        self.trained = False
+        self._stopped = False
+
+        # Results of training are kept in memory (only the last ones, as the
+        # sink would trim the others) and written at once when it finishes, or
+        # not written at all if training_results is False
+        self.training_results = config.get('training_results', True)
+        self._training_buckets = {}
+        self._training_records = 0
+        self._training_seconds = 0.0
+
+        # Restore model and state from latest checkpoint, or create them from scratch
+        self.restored = self._restore_checkpoint()
+        if not self.restored:
+            # Create model and enable inference on it
+            self.model = ModelFactory.create(model_params)
+            self.model.enableInference({'predictedField': 'value'})
+
+            # The shifter is used to bring the predictions to the actual time frame
+            self.shifter = InferenceShifter()
+
+            # The anomaly likelihood object
+            self.anomalyLikelihood = AnomalyLikelihood()
+
         # Setup class variables
-        self.db = redis.Redis('localhost')
+        self.redis_config = config.get('redis', {})
+        self.db = get_redis(**self.redis_config)
+        self.sink = get_result_sink(self.redis_config,
+                                    batch_size=config.get('result_batch_size', 100),
+                                    flush_interval=config.get('result_flush_interval', 1),
+                                    result_format=config.get('result_format', 'csv'),
+                                    storage=config.get('result_storage', 'sorted_set'),
+                                    rollup_retention=config.get('rollup_retention'))
+        self._training_rows = collections.deque(maxlen=self.sink.max_items)
         self.seconds_per_request = config['seconds_per_request']
         self.webhook = config['webhook']
         self.channel = config['channel']
+        self.digest_window = config.get('digest_window')
         self.anomaly_threshold = config['anomaly_threshold']
         self.likelihood_threshold = config['likelihood_threshold']
         self.domain = config['domain']
         self.protocol = config['protocol']
-        self.alert = False # Toogle when we get above threshold
 
-        # Setup logging
-        self.logger =  logger or logging.getLogger(__name__)
+        # Setup logging (a logger per monitor, as a process may host many)
+        self.logger = logger.getChild(self.stream.name.replace('.', '_'))
         handler = logging.handlers.RotatingFileHandler(os.environ['LOG_DIR']+"/monitor_%s.log" % self.stream.name,
                                                        maxBytes=1024*1024,
                                                        backupCount=4,
@@ -78,9 +118,12 @@ class Monitor(object):
         self.logger.info("=== Settings ===")
         self.logger.info("Webhook: %s", self.webhook)
         self.logger.info("Channel: %s", self.channel)
+        self.logger.info("Digest window: %s", self.digest_window)
         self.logger.info("Domain: %s", self.domain)
         self.logger.info("Seconds per request: %d", self.seconds_per_request)
         self.logger.info("Model params: %s", model_params)
+        if self.restored:
+            self.logger.info("Restored from checkpoint at server time %d", self.stream.servertime)
 
         # Write metadata to Redis
         try:
@@ -91,20 +134,141 @@ class Monitor(object):
         except Exception:
             self.logger.warn("Could not write results to redis.", exc_info=True)
 
-    def train(self):
+    def train(self, finish=True):
+        """ Train the model with historic data, as the stream yields it.
+            Return False if stopped before finishing (then the stream is ahead
+            of the model, so it's not consistent to checkpoint). If finish is
+            False, more historic data is still to come (e.g. from a Poller), so
+            the monitor stays untrained.
+        """
+        # After a restore the stream only returns data newer than the checkpoint
         data = self.stream.historic_data()
 
+        started = time()
         for model_input in data:
-            self.update(model_input, False) # Don't post anomalies in training
+            if self._stopped:
+                self.logger.info("Stopped while training.")
+                return False
+            self._learn(model_input)
+            self._training_records += 1
+        self._training_seconds += time() - started
+
+        if not finish:
+            return True
+
+        # Write results of training at once
+        self.sink.write_many(self.stream.id, self._training_rows, self._training_buckets.values())
+        self._training_rows.clear()
+        self._training_buckets = {}
+        self.sink.flush()
+
+        rate = self._training_records / self._training_seconds if self._training_seconds > 0 else 0
+        self.logger.info("Trained with %d records in %.1f seconds (%.1f records/s).",
+                         self._training_records, self._training_seconds, rate)
+
+        self.save_checkpoint()
+        self.trained = True
+        return True
 
     def loop(self):
-        while True:
-            data = self.stream.new_data()
+        # If stopped while training there is nothing consistent to checkpoint
+        # (train() saves one when it finishes)
+        if self._stopped:
+            return
+
+        while not self._stopped:
+            self.poll()
+
+            if not self._stopped:
+                sleep(self.seconds_per_request)
+
+        self.close()
+
+    def poll(self):
+        """ Feed new data from the stream to the model. """
+
+        data = self.stream.new_data()
+
+        for model_input in data:
+            self.update(model_input, True) # Post anomalies when online
+
+        self.checkpoint_if_due()
 
-            for model_input in data:
-                self.update(model_input, True) # Post anomalies when online
+    def close(self):
+        """ Flush results and webhooks and save a checkpoint. """
 
-            sleep(self.seconds_per_request)
+        self.sink.flush()
+        self.save_checkpoint()
+        if self.webhook is not None:
+            get_dispatcher().join(timeout=30)
+
+    def stop(self):
+        """ Ask train() and loop() to return after the current record.
+            Safe to call from a signal handler.
+        """
+        self._stopped = True
+
+    def save_checkpoint(self):
+        """ Save model, shifter, likelihood, stream state and alert flag. """
+
+        if self.checkpointer is None:
+            return
+        state = {'shifter': self.shifter,
+                 'anomaly_likelihood': self.anomalyLikelihood,
+                 'alert': self.alert,
+                 'rollups': self.rollups,
+                 'stream': self.stream.get_state()}
+        try:
+            path = self.checkpointer.save(self.model, state)
+            self.logger.info("Checkpoint saved to %s", path)
+        except Exception:
+            self.logger.warn("Could not save checkpoint.", exc_info=True)
+        self.last_checkpoint = time()
+
+    def checkpoint_if_due(self):
+        """ Save a checkpoint if checkpoint_interval seconds have passed since the last one. """
+
+        if self.checkpointer is not None and time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.save_checkpoint()
+
+    def _restore_checkpoint(self):
+        """ Load latest valid checkpoint into this monitor. Return True on success. """
+
+        if self.checkpointer is None:
+            return False
+        checkpoint = self.checkpointer.load()
+        if checkpoint is None:
+            return False
+
+        self.model, state = checkpoint
+        self.model.enableInference({'predictedField': 'value'})
+        self.shifter = state['shifter']
+        self.anomalyLikelihood = state['anomaly_likelihood']
+        self.alert = state['alert']
+        self.rollups = state.get('rollups', self.rollups)
+        self.stream.set_state(state['stream'])
+        return True
+
+    def _learn(self, model_input):
+        """ Feed a training record to the model. Like update(), but without
+            logging, thresholds or posts, keeping results to be written by train().
+        """
+        result = self.shifter.shift(self.model.run(model_input))
+        anomaly_score = result.inferences['anomalyScore']
+        likelihood = self.anomalyLikelihood.anomalyProbability(model_input['value'],
+                                                               anomaly_score,
+                                                               model_input['time'])
+
+        if self.training_results and result.inferences['multiStepPredictions'][1]:
+            row = (calendar.timegm(model_input['time'].timetuple()),
+                   model_input['raw_value'],
+                   result.rawInput['value'],
+                   result.inferences['multiStepBestPredictions'][1],
+                   anomaly_score,
+                   likelihood)
+            self._training_rows.append(row)
+            for resolution, bucket in self.rollups.add(row):
+                self._training_buckets[resolution, bucket.start] = (resolution, bucket)
 
     def update(self, model_input, is_to_post):
         # Pass the input to the model
@@ -132,26 +296,23 @@ class Monitor(object):
 
         self.logger.info("Processing: %s", strftime("%Y-%m-%d %H:%M:%S", model_input['time'].timetuple()))
 
-        # Save results to Redis
+        # Save results to Redis (buffered by the sink)
         if inference[1]:
-            try:
-                # Save in redis with key = 'results:monitor_id' and value = 'time, raw_value, actual, prediction, anomaly'
-                # * actual: is the value processed  by the NuPIC model, which can be
-                #           an average of raw_values
-                # * predicition: prediction based on 'actual' values.
-                self.db.rpush('results:%s' % self.stream.id,
-                              '%s,%.5f,%.5f,%.5f,%.5f,%.5f' % (timestamp,
-                                                          model_input['raw_value'],
-                                                          result.rawInput['value'],
-                                                          predicted,
-                                                          anomaly_score,
-                                                          likelihood))
-                max_items = 10000
-                ln = self.db.llen('results:%s' % self.stream.id)
-                if ln > max_items:
-                    self.db.ltrim('results:%s' % self.stream.id, ln - max_items, ln)
-            except Exception:
-                self.logger.warn("Could not write results to redis.", exc_info=True)
+            # Save with key = 'results:monitor_id' and value = 'time, raw_value, actual, prediction, anomaly'
+            # * actual: is the value processed  by the NuPIC model, which can be
+            #           an average of raw_values
+            # * predicition: prediction based on 'actual' values.
+            row = (timestamp,
+                   model_input['raw_value'],
+                   result.rawInput['value'],
+                   predicted,
+                   anomaly_score,
+                   likelihood)
+            self.sink.write(self.stream.id, row)
+
+            # Update rollups (min, max, mean per 5 min, 1 hour and 1 day)
+            for resolution, bucket in self.rollups.add(row):
+                self.sink.write_rollup(self.stream.id, resolution, bucket)
 
         # See if above threshold (in which case anomalous is True)
         anomalous = False
@@ -184,50 +345,34 @@ class Monitor(object):
         return {"likelihood" : likelihood,  "anomalous" : anomalous, "anomalyScore" : anomaly_score, "predicted" : predicted}
 
     def delete(self):
-        """ Remove this monitor from redis """
+        """ Remove this monitor from redis, together with its checkpoints """
 
-        self.db.delete("results:%s" % self.stream.id)
+        self.sink.delete(self.stream.id)
         self.db.delete('name:%s' % self.stream.id)
         self.db.delete('value_label:%s' % self.stream.id)
         self.db.delete('value_unit:%s' % self.stream.id)
 
+        if self.checkpointer is not None:
+            self.checkpointer.delete()
+
     def _send_post(self, report):
-        """ Send HTTP POST notification. """
+        """ Queue HTTP POST notification (or add it to the digest). """
 
         chart_url = '%s://%s?id=%s' % (self.protocol, self.domain, self.stream.id)
         if os.getenv('SERVER_TOKEN') != '':
             chart_url += '&access_token=%s' % os.getenv('SERVER_TOKEN')
 
-        if "hooks.slack.com" not in self.webhook:
-            payload = {'sent_at': datetime.utcnow().isoformat(),
-                       'report': report,
-                       'monitor': self.stream.name,
-                       'source': type(self.stream).__name__,
-                       'metric': '%s (%s)' % (self.stream.value_label, self.stream.value_unit),
-                       'chart': chart_url}
-        else:
-            payload = {'username': 'omg-monitor',
-                       'icon_url': 'https://rawgithub.com/cloudwalkio/omg-monitor/slack-integration/docs/images/post_icon.png',
-                       'text':  'Anomalous state in *%s* from _%s_:' % (self.stream.name, type(self.stream).__name__),
-                       'attachments': [{'color': 'warning',
-                                        'fields': [{'title': 'Chart',
-                                                    'value':  chart_url,
-                                                    'short': False},
-                                                   {'title': 'Metric',
-                                                    'value': self.stream.value_label,
-                                                    'short': True},
-                                                   {'title': 'Value',
-                                                    'value': str(report['model_input']['value']) + ' ' + self.stream.value_unit,
-                                                    'short': True}]}]}
-            if self.channel is not None:
-                payload['channel'] = self.channel
-
-        headers = {'Content-Type': 'application/json'}
-        try:
-            response = requests.post(self.webhook, data=json.dumps(payload), headers=headers)
-        except Exception:
-            self.logger.warn('Failed to post anomaly.', exc_info=True)
+        event = {'monitor': self.stream.name,
+                 'source': self.stream.source,
+                 'value_label': self.stream.value_label,
+                 'value_unit': self.stream.value_unit,
+                 'chart': chart_url,
+                 'report': report}
+
+        if self.digest_window:
+            # Posted with events of other monitors at the end of the window
+            get_digest(self.digest_window, self.redis_config).add(self.webhook, self.channel, event)
             return
 
-        self.logger.info('Anomaly posted with status code %d: %s', response.status_code, response.text)
-        return
+        # Posted in background by the dispatcher, so we don't block on the network
+        get_dispatcher().post(self.webhook, build_payload(self.webhook, self.channel, event), self.logger)
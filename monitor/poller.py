@@ -0,0 +1,190 @@
+import heapq
+import Queue
+import logging
+from time import time
+from multiprocessing.pool import ThreadPool
+from streams.base import BaseStream
+
+logger = logging.getLogger(__name__)
+
+class QueuedStream(BaseStream):
+    """ Stream used by monitors whose data is fetched by a Poller in another
+        process. historic_data() and new_data() return the points received
+        from the poller, which were produced by the real stream's own methods
+        (so de-duplication by servertime and transforms are the same).
+    """
+
+    @property
+    def value_label(self):
+        return self._value_label
+
+    @property
+    def value_unit(self):
+        return self._value_unit
+
+    @property
+    def source(self):
+        return self._source
+
+    def __init__(self, config):
+        super(QueuedStream, self).__init__(config)
+        self._value_label = config['value_label']
+        self._value_unit = config['value_unit']
+        self._source = config['source']
+        self.pending = []
+
+    def receive(self, data, state):
+        """ Set data to be returned next, and the real stream state after it. """
+
+        self.pending = data
+        self.set_state(state)
+
+    def historic_data(self):
+        data, self.pending = self.pending, []
+        return data
+
+    def new_data(self):
+        data, self.pending = self.pending, []
+        return data
+
+    @classmethod
+    def available_streams(cls, data):
+        raise NotImplementedError('QueuedStream only relays data from a Poller.')
+
+def queued_stream_config(stream, stream_config):
+    """ Return the configuration of a QueuedStream relaying stream. """
+
+    return dict(stream_config,
+                cache_dir=None, # The poller's stream has the cache
+                value_label=stream.value_label,
+                value_unit=stream.value_unit,
+                source=stream.source)
+
+class Poller(object):
+    """ Poll many streams from a single loop. Fetches (historic_data() first,
+        then new_data() every seconds_per_request seconds) run in a bounded
+        thread pool per stream class, at most one at a time per stream. Points
+        are sent to the queue of the worker hosting the stream's monitor as:
+            ('train' or 'data', stream id, points, stream state)
+        Historic data is sent as it's fetched, in ('train_data', ...) messages
+        of train_chunk points, the last part being sent as 'train', one chunk
+        per fetch. Queues should be bounded, so that fetching doesn't run
+        ahead of the models: when a queue is full, the message is kept until
+        the stream's next fetch (a second later), which only sends it, so no
+        thread waits for busy workers while other streams are due.
+    """
+
+    def __init__(self, concurrency=4, train_chunk=1000, full_delay=1):
+        self.concurrency = concurrency
+        self.train_chunk = train_chunk
+        self.full_delay = full_delay
+        self.entries = [] # (stream, queue, seconds_per_request)
+        self.pools = {}
+        self._training = {} # Entry -> historic_data() iterator, while training
+        self._pending = {}  # Entry -> message not sent, as its queue was full
+        self._done = Queue.Queue()
+        self._queue = []
+        self._stopped = False
+
+    def add(self, stream, queue, seconds_per_request):
+        """ Poll stream and send its points to queue. """
+
+        i = len(self.entries)
+        self.entries.append((stream, queue, seconds_per_request))
+        heapq.heappush(self._queue, (time(), i, 'train'))
+        if stream.source not in self.pools:
+            self.pools[stream.source] = ThreadPool(self.concurrency)
+
+    def run(self):
+        """ Dispatch due fetches and forward their points until stopped. """
+
+        while not self._stopped:
+            # Start every fetch that is due
+            now = time()
+            while self._queue and self._queue[0][0] <= now:
+                _, i, kind = heapq.heappop(self._queue)
+                stream = self.entries[i][0]
+                self.pools[stream.source].apply_async(self._fetch, (i, kind), callback=self._done.put)
+
+            # Wait for a fetch to finish, or the next one to be due
+            timeout = self._queue[0][0] - time() if self._queue else 1
+            try:
+                i, kind, status = self._done.get(timeout=min(max(timeout, 0.01), 1))
+            except Queue.Empty:
+                continue
+
+            seconds_per_request = self.entries[i][2]
+            if status == 'failed':
+                # Try again later
+                heapq.heappush(self._queue, (time() + seconds_per_request, i, kind))
+            elif status == 'full':
+                heapq.heappush(self._queue, (time() + self.full_delay, i, kind))
+            elif status == 'more':
+                heapq.heappush(self._queue, (time(), i, 'train'))
+            else:
+                next_due = time() if kind == 'train' else time() + seconds_per_request
+                heapq.heappush(self._queue, (next_due, i, 'data'))
+
+        for pool in self.pools.values():
+            pool.terminate()
+
+    def stop(self):
+        """ Ask run() to return. Safe to call from a signal handler. """
+
+        self._stopped = True
+
+    def _fetch(self, i, kind):
+        """ Run in the pool: fetch points and send them. Return (i, kind,
+            status), status being 'sent', 'more' (a training chunk was sent,
+            but not the last one), 'full' (kept to send it later) or 'failed'.
+        """
+        stream, queue, _ = self.entries[i]
+
+        # Points fetched before must be sent first
+        if i in self._pending:
+            message = self._pending.pop(i)
+            status = self._send(i, queue, message)
+            if status == 'sent' and message[0] == 'train_data':
+                status = 'more'
+            return i, kind, status
+
+        if kind != 'train':
+            try:
+                data = stream.new_data()
+            except Exception:
+                logger.warn("Could not fetch data of %s.", stream.name, exc_info=True)
+                return i, kind, 'failed'
+            return i, kind, self._send(i, queue, (kind, stream.id, data, stream.get_state()))
+
+        # Historic data moves the stream ahead as it's fetched, so points
+        # fetched before an error are still sent, and the next try resumes
+        # after them
+        data = []
+        try:
+            if i not in self._training:
+                self._training[i] = iter(stream.historic_data())
+            for point in self._training[i]:
+                data.append(point)
+                if len(data) >= self.train_chunk:
+                    status = self._send(i, queue, ('train_data', stream.id, data, stream.get_state()))
+                    return i, kind, 'more' if status == 'sent' else status
+        except Exception:
+            logger.warn("Could not fetch data of %s.", stream.name, exc_info=True)
+            self._training.pop(i, None)
+            if data:
+                self._send(i, queue, ('train_data', stream.id, data, stream.get_state()))
+            return i, kind, 'failed'
+
+        del self._training[i]
+        return i, kind, self._send(i, queue, ('train', stream.id, data, stream.get_state()))
+
+    def _send(self, i, queue, message):
+        """ Put message in queue if it has room, else keep it to send later.
+            Return 'sent' or 'full'.
+        """
+        try:
+            queue.put_nowait(message)
+            return 'sent'
+        except Queue.Full:
+            self._pending[i] = message
+            return 'full'
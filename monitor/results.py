@@ -0,0 +1,273 @@
+import os
+import abc
+import redis
+import logging
+import threading
+import encoding
+import rollups
+from time import sleep
+
+logger = logging.getLogger(__name__)
+
+# How results can be stored (see RedisResultSink)
+STORAGES = ('sorted_set', 'list')
+
+# Connection pools shared by every client in the process, by (host, port, db)
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_redis(host=None, port=None, db=None):
+    """ Return a Redis client using a connection pool shared by the process.
+        Arguments that are None come from REDIS_HOST, REDIS_PORT and REDIS_DB
+        environment variables, else localhost, 6379 and 0.
+    """
+    if host is None:
+        host = os.environ.get('REDIS_HOST', 'localhost')
+    if port is None:
+        port = os.environ.get('REDIS_PORT', 6379)
+    if db is None:
+        db = os.environ.get('REDIS_DB', 0)
+    port, db = int(port), int(db)
+
+    with _pools_lock:
+        key = (host, port, db)
+        if key not in _pools:
+            _pools[key] = redis.ConnectionPool(host=host, port=port, db=db)
+        return redis.Redis(connection_pool=_pools[key])
+
+class ResultSink(object):
+    """ Base class for where Monitor results are stored. """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def write(self, stream_id, row):
+        """ Store one result. The row is a tuple:
+                (timestamp, raw_value, actual, predicted, anomaly, likelihood)
+        """
+        pass
+
+    def write_many(self, stream_id, rows, buckets=()):
+        """ Store many results, and rollup buckets as (resolution, bucket). """
+
+        for row in rows:
+            self.write(stream_id, row)
+        for resolution, bucket in buckets:
+            self.write_rollup(stream_id, resolution, bucket)
+
+    @abc.abstractmethod
+    def flush(self):
+        """ Make sure every result written so far is stored. """
+        pass
+
+    @abc.abstractmethod
+    def delete(self, stream_id):
+        """ Remove every result of stream_id. """
+        pass
+
+class RedisResultSink(ResultSink):
+    """ Buffer results and write them to Redis key 'results:<stream_id>' in
+        pipelined batches, when batch_size rows are buffered or every
+        flush_interval seconds. Rows are encoded with the given encoder (see
+        encoding module) and stored in one of:
+        * 'sorted_set': scored by timestamp, so time ranges can be queried.
+          Lists left by the 'list' storage are converted on first write.
+        * 'list': in arrival order, only the last N rows can be queried.
+        Rollups are saved to 'rollup:<resolution>:<stream_id>' sorted sets,
+        and kept for rollup_retention[resolution] seconds.
+    """
+
+    def __init__(self, db, max_items=10000, batch_size=100, flush_interval=1,
+                 encoder=encoding.encode_csv, storage='sorted_set', rollup_retention=None):
+        if storage not in STORAGES:
+            raise ValueError('Unknown result storage: %s' % storage)
+
+        self.db = db
+        self.encoder = encoder
+        self.storage = storage
+        self.max_items = max_items
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rollup_retention = dict(rollups.TIERS)
+        self.rollup_retention.update(rollup_retention or {})
+
+        self._buffer = []
+        self._rollups = {} # Latest version of each updated bucket
+        self._converted = set() # Streams already checked for old lists
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        # Flush in background, so results don't wait for the next write
+        flusher = threading.Thread(target=self._flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def write(self, stream_id, row):
+        value = self.encoder(row)
+        with self._lock:
+            self._buffer.append((stream_id, row[0], value))
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def write_rollup(self, stream_id, resolution, bucket):
+        """ Store (or replace) a rollup bucket. Only the latest version of each
+            bucket since the last flush is written.
+        """
+        with self._lock:
+            self._rollups[(stream_id, resolution, bucket.start)] = bucket.encode()
+
+    def write_many(self, stream_id, rows, buckets=()):
+        """ Store many results and rollup buckets (as (resolution, bucket)) at
+            once, in a single pipelined write instead of batches.
+        """
+        values = [(row[0], self.encoder(row)) for row in rows]
+        encoded_rollups = dict(((stream_id, resolution, bucket.start), bucket.encode())
+                               for resolution, bucket in buckets)
+
+        # Keep the order with results written before
+        self.flush()
+        with self._flush_lock:
+            self._write({stream_id: values} if values else {}, encoded_rollups)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                buffered, self._buffer = self._buffer, []
+                buffered_rollups, self._rollups = self._rollups, {}
+            if not buffered and not buffered_rollups:
+                return
+
+            # Group by stream, keeping the order of the rows
+            rows = {}
+            for stream_id, timestamp, value in buffered:
+                rows.setdefault(stream_id, []).append((timestamp, value))
+            self._write(rows, buffered_rollups)
+
+    def _write(self, rows, buffered_rollups):
+        """ Write rows ({stream_id: [(timestamp, value), ...]}) and rollups
+            ({(stream_id, resolution, start): value}) in one pipeline.
+        """
+        try:
+            pipe = self.db.pipeline(transaction=False)
+            for stream_id, stream_rows in rows.iteritems():
+                key = 'results:%s' % stream_id
+                if self.storage == 'sorted_set':
+                    self._convert_list(stream_id)
+                    args = []
+                    for timestamp, value in stream_rows:
+                        args.extend([timestamp, value])
+                    pipe.execute_command('ZADD', key, *args)
+                    pipe.zremrangebyrank(key, 0, -self.max_items - 1)
+                else:
+                    pipe.rpush(key, *[value for _, value in stream_rows])
+                    pipe.ltrim(key, -self.max_items, -1)
+
+            # Replace buckets and drop the ones older than the retention
+            newest = {}
+            for (stream_id, resolution, start), value in buffered_rollups.iteritems():
+                key = 'rollup:%d:%s' % (resolution, stream_id)
+                pipe.zremrangebyscore(key, start, start)
+                pipe.execute_command('ZADD', key, start, value)
+                newest[resolution, key] = max(newest.get((resolution, key), start), start)
+            for (resolution, key), start in newest.iteritems():
+                retention = self.rollup_retention[resolution]
+                pipe.zremrangebyscore(key, '-inf', '(%d' % (start - retention))
+            pipe.execute()
+        except Exception:
+            logger.warn("Could not write %d results and %d rollups to redis.",
+                        sum(len(r) for r in rows.values()), len(buffered_rollups), exc_info=True)
+
+    def delete(self, stream_id):
+        with self._lock:
+            self._buffer = [r for r in self._buffer if r[0] != stream_id]
+            self._rollups = dict((k, v) for k, v in self._rollups.iteritems() if k[0] != stream_id)
+        self.db.delete('results:%s' % stream_id,
+                       *['rollup:%d:%s' % (resolution, stream_id) for resolution, _ in rollups.TIERS])
+
+    def _convert_list(self, stream_id):
+        """ Convert results saved as a list to a sorted set (once per stream). """
+
+        if stream_id in self._converted:
+            return
+        key = 'results:%s' % stream_id
+        if self.db.type(key) == 'list':
+            logger.info("Converting results of %s to a sorted set.", stream_id)
+            args = []
+            for value in self.db.lrange(key, 0, -1):
+                args.extend([encoding.decode(value)[0], value])
+            pipe = self.db.pipeline()
+            pipe.delete(key)
+            if args:
+                pipe.execute_command('ZADD', key, *args)
+            pipe.execute()
+        self._converted.add(stream_id)
+
+    def _flush_loop(self):
+        while True:
+            sleep(self.flush_interval)
+            self.flush()
+
+def query_results(db, stream_id, start=None, end=None, limit=None):
+    """ Return results of stream_id as decoded tuples, oldest first:
+            [(timestamp, raw_value, actual, predicted, anomaly, likelihood), ...]
+        Only results with start <= timestamp <= end are returned (both
+        optional) and, if limit is given, only the last limit of them.
+        With 'sorted_set' storage this is O(log n + k), with 'list' storage
+        the whole list is read.
+    """
+    key = 'results:%s' % stream_id
+    low = start if start is not None else '-inf'
+    high = end if end is not None else '+inf'
+
+    if db.type(key) == 'list':
+        values = db.lrange(key, 0, -1)
+        rows = [encoding.decode(v) for v in values]
+        rows = [r for r in rows if (start is None or r[0] >= start) and (end is None or r[0] <= end)]
+        return rows[-limit:] if limit else rows
+
+    if limit:
+        values = db.execute_command('ZREVRANGEBYSCORE', key, high, low, 'LIMIT', 0, limit)
+        values.reverse()
+    else:
+        values = db.execute_command('ZRANGEBYSCORE', key, low, high)
+    return [encoding.decode(v) for v in values]
+
+def query_rollups(db, stream_id, resolution, start=None, end=None):
+    """ Return rollups of stream_id with the given resolution (see rollups.TIERS)
+        and start <= bucket start <= end, oldest first, as dicts with rollups.FIELDS.
+    """
+    key = 'rollup:%d:%s' % (resolution, stream_id)
+    low = start if start is not None else '-inf'
+    high = end if end is not None else '+inf'
+    values = db.execute_command('ZRANGEBYSCORE', key, low, high)
+    return [rollups.decode(v) for v in values]
+
+# Sinks shared by the monitors of the process, by Redis and sink settings
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+def get_result_sink(redis_config=None, batch_size=100, flush_interval=1, result_format='csv',
+                    storage='sorted_set', rollup_retention=None):
+    """ Return the RedisResultSink shared by monitors with the same settings. """
+
+    redis_config = redis_config or {}
+    rollup_retention = rollup_retention or {}
+    key = (tuple(sorted(redis_config.items())), batch_size, flush_interval, result_format, storage,
+           tuple(sorted(rollup_retention.items())))
+    with _sinks_lock:
+        if key not in _sinks:
+            _sinks[key] = RedisResultSink(get_redis(**redis_config),
+                                          batch_size=batch_size,
+                                          flush_interval=flush_interval,
+                                          encoder=encoding.get_encoder(result_format),
+                                          storage=storage,
+                                          rollup_retention=rollup_retention)
+        return _sinks[key]
+
+def flush_all():
+    """ Flush every sink of the process (e.g. at shutdown). """
+
+    with _sinks_lock:
+        sinks = _sinks.values()
+    for sink in sinks:
+        sink.flush()
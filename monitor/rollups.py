@@ -0,0 +1,95 @@
+DAY = 60*60*24
+
+# Rollup tiers: (resolution in seconds, default retention in seconds)
+TIERS = ((300, 30*DAY),
+         (3600, 365*DAY),
+         (DAY, 5*365*DAY))
+
+# Rollups are saved in 'rollup:<resolution>:<stream_id>' sorted sets, scored by
+# bucket start, as CSV strings with these fields:
+FIELDS = ('time', 'count',
+          'raw_min', 'raw_max', 'raw_mean',
+          'actual_mean', 'predicted_mean',
+          'anomaly_min', 'anomaly_max', 'anomaly_mean',
+          'likelihood_max')
+
+class Bucket(object):
+    """ Aggregates of the results in [start, start + resolution). """
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.raw_min = self.raw_max = self.raw_sum = 0.0
+        self.actual_sum = self.predicted_sum = 0.0
+        self.anomaly_min = self.anomaly_max = self.anomaly_sum = 0.0
+        self.likelihood_max = 0.0
+
+    def add(self, row):
+        """ Add a result row (timestamp, raw_value, actual, predicted, anomaly, likelihood). """
+
+        _, raw_value, actual, predicted, anomaly, likelihood = row
+        if self.count == 0:
+            self.raw_min = self.raw_max = raw_value
+            self.anomaly_min = self.anomaly_max = anomaly
+            self.likelihood_max = likelihood
+        else:
+            self.raw_min = min(self.raw_min, raw_value)
+            self.raw_max = max(self.raw_max, raw_value)
+            self.anomaly_min = min(self.anomaly_min, anomaly)
+            self.anomaly_max = max(self.anomaly_max, anomaly)
+            self.likelihood_max = max(self.likelihood_max, likelihood)
+        self.raw_sum += raw_value
+        self.actual_sum += actual
+        self.predicted_sum += predicted
+        self.anomaly_sum += anomaly
+        self.count += 1
+
+    def encode(self):
+        """ Encode as a CSV string with FIELDS. """
+
+        return '%d,%d,%.5f,%.5f,%.5f,%.5f,%.5f,%.5f,%.5f,%.5f,%.5f' % (self.start, self.count,
+                                                                     self.raw_min, self.raw_max,
+                                                                     self.raw_sum/self.count,
+                                                                     self.actual_sum/self.count,
+                                                                     self.predicted_sum/self.count,
+                                                                     self.anomaly_min, self.anomaly_max,
+                                                                     self.anomaly_sum/self.count,
+                                                                     self.likelihood_max)
+
+def decode(value):
+    """ Decode a rollup saved by Bucket.encode into a dict with FIELDS. """
+
+    fields = value.split(',')
+    rollup = dict(zip(FIELDS[2:], [float(f) for f in fields[2:]]))
+    rollup['time'] = int(fields[0])
+    rollup['count'] = int(fields[1])
+    return rollup
+
+class Rollups(object):
+    """ Incremental rollups of the results of a stream, one bucket per tier.
+        Kept by Monitor (and saved in its checkpoints).
+    """
+
+    def __init__(self, resolutions=None):
+        self.resolutions = resolutions or [resolution for resolution, _ in TIERS]
+        self.buckets = {}
+
+    def add(self, row):
+        """ Add a result row to the current bucket of each tier, starting a new
+            bucket when the row is past it. Return the updated buckets as a list
+            of (resolution, bucket).
+        """
+        timestamp = int(row[0])
+        updated = []
+        for resolution in self.resolutions:
+            start = timestamp - timestamp % resolution
+            bucket = self.buckets.get(resolution)
+            if bucket is not None and start < bucket.start:
+                # Late row, its bucket was already closed
+                continue
+            if bucket is None or bucket.start != start:
+                bucket = Bucket(start)
+                self.buckets[resolution] = bucket
+            bucket.add(row)
+            updated.append((resolution, bucket))
+        return updated
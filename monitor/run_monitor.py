@@ -2,8 +2,15 @@
 
 import sys
 import os
+import signal
+import Queue
+import argparse
 import multiprocessing
-from monitor import Monitor
+from monitor import Monitor, build_model_params
+from scheduler import Scheduler
+from checkpoint import Checkpointer, params_digest
+from poller import Poller, QueuedStream, queued_stream_config
+from transforms import build_pipeline
 import logging
 import logging.handlers
 import yaml
@@ -52,9 +59,46 @@ def validate(config):
         if 'moving_average_window' in config['parameters'].keys():
             if not isinstance(config['parameters']['moving_average_window'], (int, long)):
                 message = message + 'Moving average window should be an integer.\n'
+        if 'result_batch_size' in config['parameters'].keys():
+            if not isinstance(config['parameters']['result_batch_size'], (int, long)):
+                message = message + 'Result batch size should be an integer.\n'
+        if 'result_flush_interval' in config['parameters'].keys():
+            if not isinstance(config['parameters']['result_flush_interval'], (float, int, long)):
+                message = message + 'Result flush interval should be a number.\n'
+        if 'result_format' in config['parameters'].keys():
+            if config['parameters']['result_format'] not in ('csv', 'binary'):
+                message = message + 'Result format should be csv or binary.\n'
+        if 'result_storage' in config['parameters'].keys():
+            if config['parameters']['result_storage'] not in ('sorted_set', 'list'):
+                message = message + 'Result storage should be sorted_set or list.\n'
+        if 'rollup_retention_days' in config['parameters'].keys():
+            retention = config['parameters']['rollup_retention_days']
+            if not isinstance(retention, dict) or set(retention.keys()) - set([300, 3600, 86400]):
+                message = message + 'Rollup retention days should map 300, 3600 or 86400 to days.\n'
+        for key in ('training_window', 'training_rows', 'backfill_concurrency'):
+            if key in config['parameters'].keys():
+                if not isinstance(config['parameters'][key], (int, long)) or config['parameters'][key] < 1:
+                    message = message + '%s should be a positive integer.\n' % key.replace('_', ' ').capitalize()
+        if 'rate_limit' in config['parameters'].keys():
+            if not isinstance(config['parameters']['rate_limit'], (float, int, long)) or config['parameters']['rate_limit'] <= 0:
+                message = message + 'Rate limit should be a positive number.\n'
+        if 'rate_limit_burst' in config['parameters'].keys():
+            if not isinstance(config['parameters']['rate_limit_burst'], (int, long)) or config['parameters']['rate_limit_burst'] < 1:
+                message = message + 'Rate limit burst should be a positive integer.\n'
+        if 'training_results' in config['parameters'].keys():
+            if not isinstance(config['parameters']['training_results'], bool):
+                message = message + 'Training results should be true or false.\n'
+        if 'checkpoint_interval' in config['parameters'].keys():
+            if not isinstance(config['parameters']['checkpoint_interval'], (int, long)):
+                message = message + 'Checkpoint interval should be an integer.\n'
         if 'scaling_factor' in config['parameters'].keys():
             if not isinstance(config['parameters']['scaling_factor'], (float, int, long)):
                 message = message + 'Scaling factor window should be a number.\n'
+        if 'transforms' in config['parameters'].keys():
+            try:
+                build_pipeline(config['parameters'])
+            except ValueError, e:
+                message = message + '%s\n' % e
         if 'likelihood_threshold' in config['parameters'].keys():
             if not isinstance(config['parameters']['likelihood_threshold'], (float, int, long)):
                 message = message + 'Likelihood threshold should be a number between 0 and 1.\n'
@@ -65,6 +109,12 @@ def validate(config):
                 message = message + 'Anomaly threshold should be a number between 0 and 1.\n'
             elif config['parameters']['anomaly_threshold'] < 0 or config['parameters']['likelihood_threshold'] > 1:
                 message = message + 'Anomaly threshold should be a number between 0 and 1.\n'
+    if 'digest_window' in keys:
+        if not isinstance(config['digest_window'], (int, long)) or config['digest_window'] <= 0:
+            message = message + 'Digest window should be a positive integer.\n'
+    if 'redis' in keys:
+        if not isinstance(config['redis'], dict):
+            message = message + 'Redis should be a map with host, port and db.\n'
     if 'monitors' in keys:
         if not isinstance(config['monitors'], list):
             message = message + 'Monitors should be a list of ids.\n'
@@ -83,11 +133,22 @@ def extract_monitor_config(config):
                       'seconds_per_request': int(config['parameters'].get('seconds_per_request', 60)),
                       'webhook': config.get('webhook', None),
                       'channel': config.get('channel', None),
+                      'digest_window': config.get('digest_window', None),
                       'anomaly_threshold': config['parameters'].get('anomaly_threshold', None),
                       'likelihood_threshold': config['parameters'].get('likelihood_threshold', None),
                       'domain': config.get('domain', 'localhost'),
                       'protocol': config.get('protocol', 'http'),
-                      'nupic_model_params': config.get('nupic_model_params', {})}
+                      'nupic_model_params': config.get('nupic_model_params', {}),
+                      'checkpoint_dir': os.environ.get('CHECKPOINT_DIR'),
+                      'checkpoint_interval': int(config['parameters'].get('checkpoint_interval', 3600)),
+                      'training_results': config['parameters'].get('training_results', True),
+                      'redis': config.get('redis', {}),
+                      'result_batch_size': int(config['parameters'].get('result_batch_size', 100)),
+                      'result_flush_interval': float(config['parameters'].get('result_flush_interval', 1)),
+                      'result_format': config['parameters'].get('result_format', 'csv'),
+                      'result_storage': config['parameters'].get('result_storage', 'sorted_set'),
+                      'rollup_retention': dict((resolution, int(days*60*60*24)) for resolution, days
+                                               in config['parameters'].get('rollup_retention_days', {}).items())}
     return monitor_config
 
 def extract_stream_config(config):
@@ -127,10 +188,18 @@ def extract_stream_config(config):
     stream_config = {'metric': metric,
                      'moving_average_window': int(config['parameters'].get('moving_average_window', 1)),
                      'scaling_factor': float(config['parameters'].get('scaling_factor', 1)),
+                     'transforms': config['parameters'].get('transforms', None),
+                     'training_window': config['parameters'].get('training_window', None),
+                     'training_rows': config['parameters'].get('training_rows', None),
+                     'backfill_concurrency': config['parameters'].get('backfill_concurrency', 4),
+                     'cache_dir': os.environ.get('CACHE_DIR'),
+                     'rate_limit': config['parameters'].get('rate_limit', 60),
+                     'rate_limit_burst': config['parameters'].get('rate_limit_burst', 10),
+                     'redis': config.get('redis', {}),
                      'credentials': credentials}
     return stream_config, streams, StreamClass
 
-def run(StreamClass, stream_config, monitor_config):
+def create_monitor(StreamClass, stream_config, monitor_config):
     """ Instantiate a monitor for StreamClass using given configurations """
 
     # Instantiate monitor
@@ -139,13 +208,18 @@ def run(StreamClass, stream_config, monitor_config):
     # Instantiate stream
     stream = StreamClass(stream_config)
 
-    # Add stream to monitor configuration
-    monitor_config['stream'] = stream
+    # Instantiate monitor (restoring it from a checkpoint, if there is one)
+    return Monitor(dict(monitor_config, stream=stream))
 
-    # Instantiate monitor
-    monitor = Monitor(monitor_config)
+def run(StreamClass, stream_config, monitor_config):
+    """ Run a monitor for StreamClass in its own process """
 
-    # Train monitor
+    monitor = create_monitor(StreamClass, stream_config, monitor_config)
+
+    # On SIGTERM finish the current record, save a checkpoint and leave
+    signal.signal(signal.SIGTERM, lambda signum, frame: monitor.stop())
+
+    # Train monitor (only with data newer than the checkpoint, if restored)
     logger.info("Starting training: %s", stream_config['name'])
     monitor.train()
 
@@ -153,13 +227,119 @@ def run(StreamClass, stream_config, monitor_config):
     logger.info("Going online: %s", stream_config['name'])
     monitor.loop()
 
-if __name__ == "__main__":
-    if(len(sys.argv) < 2):
-        logger.info("Usage: run_monitor.py [config1.yaml config2.yaml ...]")
-        sys.exit(0)
+def run_worker(jobs):
+    """ Run many monitors in one process. Jobs are tuples:
+            (StreamClass, stream_config, monitor_config)
+    """
+    monitors = []
+    for StreamClass, stream_config, monitor_config in jobs:
+        try:
+            monitors.append(create_monitor(StreamClass, stream_config, monitor_config))
+        except Exception:
+            logger.error("Could not start monitor: %s", stream_config['name'], exc_info=True)
+
+    scheduler = Scheduler(monitors)
+
+    # On SIGTERM finish the current task, save checkpoints and leave
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+
+    scheduler.run()
+
+def run_queue_worker(jobs, queue):
+    """ Run many monitors in one process, fed with data from a Poller through
+        queue. Jobs are tuples (queued_stream_config, monitor_config).
+    """
+    monitors = {}
+    for stream_config, monitor_config in jobs:
+        try:
+            monitors[stream_config['id']] = Monitor(dict(monitor_config, stream=QueuedStream(stream_config)))
+        except Exception:
+            logger.error("Could not start monitor: %s", stream_config['name'], exc_info=True)
+
+    # On SIGTERM finish the current task, save checkpoints and leave
+    stopped = []
+    def stop(signum, frame):
+        stopped.append(signum)
+        for monitor in monitors.values():
+            monitor.stop()
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopped:
+        try:
+            kind, stream_id, data, state = queue.get(timeout=1)
+        except Queue.Empty:
+            continue
+
+        monitor = monitors.get(stream_id)
+        if monitor is None:
+            continue
+        monitor.stream.receive(data, state)
+        try:
+            if kind == 'train_data':
+                # Part of the historic data, more to come
+                monitor.train(finish=False)
+            elif kind == 'train':
+                logger.info("Starting training: %s", monitor.stream.name)
+                monitor.train()
+                logger.info("Going online: %s", monitor.stream.name)
+            else:
+                monitor.poll()
+        except Exception:
+            logger.error("Error running monitor %s.", monitor.stream.name, exc_info=True)
+
+    for monitor in monitors.values():
+        if monitor.trained:
+            monitor.close()
+
+def run_poller(jobs, workers, concurrency, queue_size=8):
+    """ Poll every stream from this process and run their monitors in workers
+        processes. Return the list of worker processes. Fetching waits while
+        a worker has queue_size messages (of at most a training chunk) pending.
+    """
+    poller = Poller(concurrency)
+    queues = [multiprocessing.Queue(maxsize=queue_size) for _ in range(workers)]
+    workers_jobs = [[] for _ in range(workers)]
+
+    for StreamClass, stream_config, monitor_config in jobs:
+        try:
+            stream = StreamClass(stream_config)
+        except Exception:
+            logger.error("Could not start stream: %s", stream_config['name'], exc_info=True)
+            continue
+
+        # Resume from the checkpoint, as the monitor will
+        if monitor_config['checkpoint_dir']:
+            params = params_digest(build_model_params(monitor_config))
+            state = Checkpointer(monitor_config['checkpoint_dir'], stream.id, params=params).load_state()
+            if state is not None:
+                stream.set_state(state['stream'])
+
+        worker = len(poller.entries) % workers
+        poller.add(stream, queues[worker], monitor_config['seconds_per_request'])
+        workers_jobs[worker].append((queued_stream_config(stream, stream_config), monitor_config))
 
     jobs_list = []
-    for config_file in sys.argv[1:]:
+    for i in range(workers):
+        jobs_list.append(multiprocessing.Process(target=run_queue_worker, args=(workers_jobs[i], queues[i])))
+        jobs_list[len(jobs_list) - 1].start()
+
+    # Stop polling and pass SIGTERM along to the workers, so they can save their checkpoints
+    def terminate(signum, frame):
+        poller.stop()
+        for job in jobs_list:
+            job.terminate()
+    signal.signal(signal.SIGTERM, terminate)
+
+    logger.info("Polling %d streams for %d workers.", len(poller.entries), workers)
+    poller.run()
+    return jobs_list
+
+def read_jobs(config_files):
+    """ Read configuration files and return a list of monitors to run, as tuples:
+            (StreamClass, stream_config, monitor_config)
+    """
+    jobs = []
+    for config_file in config_files:
         # Parse YAML configuration file
         try:
             config = yaml.load(file(config_file, 'r'))
@@ -186,20 +366,12 @@ if __name__ == "__main__":
         if monitors_ids is None:
             logger.info('No monitors IDs in configuration file. Will run everything.')
 
-            # Start the monitors sessions
             for stream in streams:
-                stream_id = stream['id']
-                stream_name = stream['name']
-
                 # Set stream identification
-                stream_config['id'] = stream_id
-                stream_config['name'] = stream_name
-
-                # Start job
-                jobs_list.append(multiprocessing.Process(target=run, args=(StreamClass, stream_config, monitor_config)))
-                jobs_list[len(jobs_list) - 1].start()
+                jobs.append((StreamClass,
+                             dict(stream_config, id=stream['id'], name=stream['name']),
+                             monitor_config))
         else: # Run streams passed
-            # Start the monitors sessions
             for stream_id in monitors_ids:
                 stream_id = str(stream_id)
                 stream_name = None
@@ -214,12 +386,55 @@ if __name__ == "__main__":
                     continue
 
                 # Set stream identification
-                stream_config['id'] = stream_id
-                stream_config['name'] = stream_name
+                jobs.append((StreamClass,
+                             dict(stream_config, id=stream_id, name=stream_name),
+                             monitor_config))
+    return jobs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run monitors for the streams in the configuration files.')
+    parser.add_argument('config_files', metavar='config.yaml', nargs='+')
+    parser.add_argument('--pool', action='store_true',
+                        help='run monitors in a pool of worker processes, instead of a process per monitor')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes with --pool (defaults to the number of CPUs)')
+    parser.add_argument('--max-monitors', type=int, default=None,
+                        help='maximum number of monitors to run, for all configuration files')
+    parser.add_argument('--poller', action='store_true',
+                        help='fetch data of every stream from this process and feed the workers (implies --pool)')
+    parser.add_argument('--poller-concurrency', type=int, default=4,
+                        help='maximum number of concurrent fetches per stream source with --poller')
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.config_files)
+    if args.max_monitors is not None and len(jobs) > args.max_monitors:
+        logger.warn("Found %d monitors, but will only run %d of them.", len(jobs), args.max_monitors)
+        jobs = jobs[:args.max_monitors]
+
+    jobs_list = []
+    if args.poller:
+        workers = max(1, min(args.workers, len(jobs)))
+        jobs_list = run_poller(jobs, workers, args.poller_concurrency)
+    elif args.pool:
+        # Spread monitors over the workers
+        workers = max(1, min(args.workers, len(jobs)))
+        logger.info("Running %d monitors in %d workers.", len(jobs), workers)
+        for i in range(workers):
+            jobs_list.append(multiprocessing.Process(target=run_worker, args=(jobs[i::workers],)))
+            jobs_list[len(jobs_list) - 1].start()
+    else:
+        # Start the monitors sessions
+        for StreamClass, stream_config, monitor_config in jobs:
+            jobs_list.append(multiprocessing.Process(target=run, args=(StreamClass, stream_config, monitor_config)))
+            jobs_list[len(jobs_list) - 1].start()
+
+    # Pass SIGTERM along to the monitors, so they can save their checkpoints
+    def terminate(signum, frame):
+        for job in jobs_list:
+            job.terminate()
+    if not args.poller:
+        signal.signal(signal.SIGTERM, terminate)
 
-                # Start job
-                jobs_list.append(multiprocessing.Process(target=run, args=(StreamClass, stream_config, monitor_config)))
-                jobs_list[len(jobs_list) - 1].start()
     # Join jobs
     for job in jobs_list:
         logger.info("Joining job %s.", job.name)
@@ -2,14 +2,22 @@
 
 import os
 from monitor import Monitor
+from results import flush_all
+from webhooks import get_dispatcher
+from transforms import build_pipeline, build_buckets, MovingAverage
+from lineprotocol import LineBuffer, start_listeners
+from ingest import IngestQueues
 import logging
 import logging.handlers
 import SocketServer
 import BaseHTTPServer
 import json
+import math
+import urlparse
 from datetime import datetime
-from collections import deque
 import time
+import signal
+import sys
 import threading
 
 
@@ -36,31 +44,197 @@ current_monitors = {}
 # track the last time something was seen
 last_seen_input = {}
 
-# keep a list for moving average purposes
-moving_averages = {}
+# Requests are served concurrently: registry_lock guards the dicts above (and
+# check_locks), and each check has a lock so that its values are processed
+# one at a time, while different checks proceed in parallel
+registry_lock = threading.Lock()
+check_locks = {}
 
-def get_monitor(check_id, config):
-    """ Get or create a new monitor with optional config """
+# Points received with the line protocol, if enabled
+line_buffer = None
+
+# Queues of pushed points, if processing them apart from requests is enabled
+# (with INGEST_QUEUE_SIZE)
+ingest_queues = None
 
-    last_seen_input[check_id] = time.time()
+def check_lock(check_id):
+    """ Return the lock of check_id. """
 
-    if check_id not in current_monitors:
-        current_monitors[check_id] = new_monitor(check_id, config)
-        moving_average_window = int(config.get('moving_average_window', 10))
-        moving_averages[check_id] = deque([0.0] * moving_average_window, maxlen=moving_average_window)
-    return (current_monitors[check_id], moving_averages[check_id])
+    with registry_lock:
+        if check_id not in check_locks:
+            check_locks[check_id] = threading.Lock()
+        return check_locks[check_id]
+
+def get_monitor(check_id, config):
+    """ Get or create a new monitor with optional config (the caller must
+        hold the check's lock)
+    """
+    with registry_lock:
+        last_seen_input[check_id] = time.time()
+        monitor = current_monitors.get(check_id)
+
+    # Create it without holding up other checks
+    if monitor is None:
+        monitor = new_monitor(check_id, config)
+        with registry_lock:
+            current_monitors[check_id] = monitor
+    return monitor
+
+def parse_point(point):
+    """ Return (check_id, timestamp, value) of a pushed point dict, with time
+        and value as floats. Raise ValueError if it lacks any of them, if
+        check_id is not a string or number, or if time or value is not a
+        finite number.
+    """
+    try:
+        check_id = point['check_id']
+        timestamp, value = float(point['time']), float(point['value'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Invalid point')
+    if isinstance(check_id, bool) or not isinstance(check_id, (basestring, int, long, float)):
+        raise ValueError('Invalid check_id')
+    if any(math.isnan(x) or math.isinf(x) for x in (timestamp, value)):
+        raise ValueError('Time and value should be finite numbers')
+    return check_id, timestamp, value
+
+def push(check_id, value, timestamp, config=None):
+    """ Feed a pushed value of check_id (at timestamp, in seconds) to its
+        monitor, creating it if needed. Return the monitor's result.
+    """
+    with check_lock(check_id):
+        monitor = get_monitor(check_id, config or {})
+        res = _update(monitor, value, timestamp)
+        monitor.checkpoint_if_due()
+        return res
+
+def push_many(check_id, points, config=None):
+    """ Feed pushed (timestamp, value) pairs of check_id, in the given order,
+        holding the check's lock once. Return the list of results, with an
+        {'error': ...} dict for points that failed.
+    """
+    results = []
+    with check_lock(check_id):
+        monitor = get_monitor(check_id, config or {})
+        for timestamp, value in points:
+            try:
+                results.append(_update(monitor, value, timestamp))
+            except Exception, e:
+                logger.warn("Could not process point of %s.", check_id, exc_info=True)
+                results.append({'error': str(e)})
+        monitor.checkpoint_if_due()
+    return results
+
+def _update(monitor, value, timestamp):
+    # Stored as raw value as well, so it must be what the model sees
+    value = float(value)
+    stream = monitor.stream
+    if stream.buckets is None:
+        res = _run(monitor, value, timestamp)
+        stream.servertime = timestamp
+        return res
+
+    # Run the model once per closed bucket, answering with the result of the
+    # last one and the state of the open bucket
+    for start, bucket_value in stream.buckets.add(value, timestamp):
+        stream.last_result = _run(monitor, bucket_value, start)
+    stream.servertime = timestamp
+    res = dict(stream.last_result or {})
+    res['bucket'] = {'time': stream.buckets.bucket[0], 'count': stream.buckets.bucket[1]}
+    return res
+
+def _run(monitor, value, timestamp):
+    smoothValue = monitor.stream.transform(value, timestamp)
+    model_input = {'time': datetime.utcfromtimestamp(timestamp), 'value': smoothValue, 'raw_value': value}
+    res = monitor.update(model_input, True)
+    res['current_value'] = smoothValue
+    return res
+
+def push_bulk(points, detail=False):
+    """ Feed a list of point dicts ({check_id, time, value}, optionally with
+        config) of many checks. Points are grouped by check and fed in time
+        order. Return a summary of the points received, processed and failed
+        (invalid or failed to process), with the last result of each check.
+        If detail is True, return instead the result of each point, in the
+        order of points.
+    """
+    results = [None] * len(points)
+    groups = {} # check_id -> [(time, index of point, value)]
+    configs = {}
+    for i, point in enumerate(points):
+        try:
+            check_id, timestamp, value = parse_point(point)
+        except ValueError, e:
+            results[i] = {'error': str(e)}
+            continue
+        groups.setdefault(check_id, []).append((timestamp, i, value))
+        if 'config' in point and check_id not in configs:
+            configs[check_id] = point['config']
+
+    summary = {'received': len(points), 'processed': 0, 'errors': 0, 'checks': {}}
+    for check_id, group in groups.iteritems():
+        group.sort()
+        try:
+            group_results = push_many(check_id, [(t, v) for t, _, v in group], configs.get(check_id))
+        except Exception, e:
+            # Could not create the monitor
+            logger.warn("Could not process points of %s.", check_id, exc_info=True)
+            group_results = [{'error': str(e)}] * len(group)
+        for (_, i, _), res in zip(group, group_results):
+            results[i] = res
+        summary['checks'][check_id] = {'points': len(group), 'last': group_results[-1]}
+
+    if detail:
+        return {'results': results}
+    summary['errors'] = len([r for r in results if 'error' in r])
+    summary['processed'] = len(points) - summary['errors']
+    return summary
+
+def queue_bulk(points):
+    """ Queue a list of point dicts like push_bulk, for ingest_queues to
+        process them. The points of a check are queued all or none. Return a
+        summary of the points received, queued and rejected (invalid or with
+        no room), with the queue depth of each check.
+    """
+    groups = {}
+    configs = {}
+    invalid = 0
+    for point in points:
+        try:
+            check_id, timestamp, value = parse_point(point)
+        except ValueError:
+            invalid += 1
+            continue
+        groups.setdefault(check_id, []).append((timestamp, value))
+        if 'config' in point and check_id not in configs:
+            configs[check_id] = point['config']
+
+    summary = {'received': len(points), 'queued': 0, 'rejected': invalid, 'checks': {}}
+    for check_id, group in groups.iteritems():
+        group.sort(key=lambda point: point[0])
+        depth = ingest_queues.put(check_id, group, configs.get(check_id))
+        if depth is None:
+            summary['rejected'] += len(group)
+            depth = ingest_queues.depth(check_id)
+        else:
+            summary['queued'] += len(group)
+        summary['checks'][check_id] = {'points': len(group), 'queue_depth': depth}
+    return summary
 
 def garbage_collect(timeout):
     """ Garbage collect checks that havent' seen action in a while to save memory """
 
-    to_remove = []
-    for check_id in last_seen_input:
-        if (time.time() - last_seen_input[check_id] > timeout):
-            to_remove.append(check_id)
+    with registry_lock:
+        to_remove = [check_id for check_id, seen in last_seen_input.items()
+                     if time.time() - seen > timeout]
 
     for check_id in to_remove:
-        logger.info("Garbage collecting: %s", check_id)
-        remove_monitor(check_id)
+        with check_lock(check_id):
+            # It may have seen action meanwhile
+            with registry_lock:
+                if time.time() - last_seen_input.get(check_id, 0) <= timeout:
+                    continue
+            logger.info("Garbage collecting: %s", check_id)
+            remove_monitor(check_id)
 
 
 def gc_task():
@@ -72,16 +246,20 @@ def gc_task():
             time.sleep(cleanup_interval)
 
     worker = threading.Thread(target=do_gc, args=[])
+    worker.daemon = True # Don't keep the process alive on SIGTERM
     worker.start()
 
 def remove_monitor(check_id):
-    """ Save some memory by clearing monitor - stopping nupic as well as redis storage """
-
-    del last_seen_input[check_id]
-    del moving_averages[check_id]
-    mon = current_monitors[check_id]
-    mon.delete()
-    del current_monitors[check_id]
+    """ Save some memory by clearing monitor - stopping nupic as well as redis
+        storage (the caller must hold the check's lock)
+    """
+    with registry_lock:
+        last_seen_input.pop(check_id, None)
+        mon = current_monitors.pop(check_id, None)
+    if ingest_queues is not None:
+        ingest_queues.forget(check_id)
+    if mon is not None:
+        mon.delete()
 
 class Dynamic(object):
     """ Class to provide a stream of data to NuPIC. """
@@ -94,12 +272,51 @@ class Dynamic(object):
     def value_unit(self):
         return self.unit
 
+    @property
+    def source(self):
+        return type(self).__name__
+
     def __init__(self, config):
         self.id = config['id']
         self.name = config['name']
         self.unit = config['unit']
         self.label = config['label']
 
+        # Time of the last pushed value and transforms (the same as the other
+        # streams, but with a moving average of 10 values by default)
+        self.servertime = 0
+        self.pipeline = build_pipeline(dict({'moving_average_window': 10}, **config))
+
+        # Optional time buckets folding values before the model, and the
+        # result of the model for the last closed bucket
+        self.buckets = build_buckets(config)
+        self.last_result = None
+
+    def transform(self, value, timestamp):
+        """ Return value after the transforms. """
+
+        return self.pipeline.apply(float(value), timestamp)
+
+    def get_state(self):
+        """ Return the state needed to resume this stream (used in checkpoints). """
+
+        state = {'servertime': self.servertime, 'transforms': self.pipeline.get_state()}
+        if self.buckets is not None:
+            state['bucket'] = self.buckets.get_state()
+        return state
+
+    def set_state(self, state):
+        """ Resume this stream from a state returned by get_state. """
+
+        self.servertime = state['servertime']
+        if 'transforms' in state:
+            self.pipeline.set_state(state['transforms'])
+        elif self.pipeline.stages and isinstance(self.pipeline.stages[0], MovingAverage):
+            # From before transforms were configurable
+            self.pipeline.stages[0].set_state(state['history'])
+        if self.buckets is not None and 'bucket' in state:
+            self.buckets.set_state(state['bucket'])
+
 def new_monitor(check_id, config):
     """ Return a new monitor with given check_id and config """
 
@@ -109,11 +326,16 @@ def new_monitor(check_id, config):
                       'seconds_per_request': 60,
                       'webhook': None,
                       'channel': None,
+                      'digest_window': int(os.environ.get('DIGEST_WINDOW', 0)) or None,
                       'likelihood_threshold': None,
                       'anomaly_threshold': 0.9,
                       'domain': 'localhost',
                       'protocol': 'http',
-                      'nupic_model_params': {'spParams': {'maxBoost': 1.1}}}
+                      'nupic_model_params': {'spParams': {'maxBoost': 1.1}},
+                      'checkpoint_dir': os.environ.get('CHECKPOINT_DIR'),
+                      'checkpoint_interval': 3600,
+                      'result_format': os.environ.get('RESULT_FORMAT', 'csv'),
+                      'result_storage': os.environ.get('RESULT_STORAGE', 'sorted_set')}
     monitor_config.update(config)
 
     logger.info("Monitor configuration: %s", monitor_config)
@@ -134,17 +356,76 @@ def new_monitor(check_id, config):
     # Add stream to monitor configuration
     monitor_config['stream'] = stream
 
-    # Instantiate monitor
+    # Instantiate monitor (restoring it from a checkpoint, if there is one)
     return Monitor(monitor_config)
 
+def save_checkpoints(signum, frame):
+    """ Checkpoint every monitor, flush results and webhooks and exit (used as SIGTERM handler) """
+
+    if line_buffer is not None:
+        line_buffer.flush()
+    if ingest_queues is not None and not ingest_queues.wait(timeout=60):
+        logger.warn("Exiting with queued points: %s", ingest_queues.depths())
+    with registry_lock:
+        monitors = current_monitors.items()
+    for check_id, monitor in monitors:
+        logger.info("Saving checkpoint: %s", check_id)
+        with check_lock(check_id):
+            monitor.save_checkpoint()
+    flush_all()
+    get_dispatcher().join(timeout=30)
+    sys.exit(0)
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serve each connection in its own thread. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
 class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """ This is the http entrypoint for json data - streams created on the fly """
 
-    def do_GET(s):
-        s.send_response(200)
-        s.send_header("Content-type", "text/html")
+    # Keep connections alive (every response must have a Content-Length)
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(s, code, content_type, body, headers=None):
+        s.send_response(code)
+        s.send_header("Content-type", content_type)
+        for name, value in (headers or {}).items():
+            s.send_header(name, value)
+        s.send_header("Content-Length", str(len(body)))
         s.end_headers()
-        s.wfile.write("<html><head><title>Simple http data input.</title></head>")
+        s.wfile.write(body)
+
+    def read_json(s):
+        """ Return the JSON request, or None after answering 400 if invalid. """
+
+        varLen = int(s.headers.get('Content-Length', 0))
+        postVars = s.rfile.read(varLen)
+        try:
+            req = json.loads(postVars)
+            if isinstance(req['check_id'], (list, dict)):
+                raise TypeError('Invalid check_id')
+        except (ValueError, KeyError, TypeError):
+            s.send_body(400, "application/json", '{"error": "Invalid request"}\n')
+            return None
+        return req
+
+    def send_queue_full(s, body):
+        """ Answer 429, for producers to back off while queues are full. """
+
+        s.send_body(429, "application/json", json.dumps(body), {"Retry-After": "1"})
+
+    def do_GET(s):
+        if urlparse.urlparse(s.path).path == '/queues':
+            depths = ingest_queues.depths() if ingest_queues is not None else {}
+            body = {'enabled': ingest_queues is not None,
+                    'size': ingest_queues.size if ingest_queues is not None else None,
+                    'total': sum(depths.values()),
+                    'checks': depths}
+            s.send_body(200, "application/json", json.dumps(body))
+            return
+
         usage = """
         <body><p>Post here something like:
           <code>
@@ -154,38 +435,96 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         <p>
         </body>
         """
-        s.wfile.write(usage)
-        s.wfile.write("</body></html>")
+        s.send_body(200, "text/html",
+                    "<html><head><title>Simple http data input.</title></head>" + usage + "</body></html>")
 
     def do_POST(s):
-        varLen = int(s.headers['Content-Length'])
-        postVars = s.rfile.read(varLen)
-        req = json.loads(postVars)
-        (monitor, averages) = get_monitor(req['check_id'], req.get('config', {}))
-        averages.appendleft(req['value'])
-        smoothValue = sum(averages)/len(averages)
-        model_input = {'time': datetime.utcfromtimestamp(req['time']), 'value': smoothValue, 'raw_value': smoothValue}
-        res = monitor.update(model_input, True)
-        res['current_value'] = smoothValue
-        s.send_response(200)
-        s.send_header("Content-type", "application/json")
-        s.end_headers()
-        s.wfile.write(json.dumps(res))
+        if urlparse.urlparse(s.path).path == '/bulk':
+            return s.do_bulk()
+
+        req = s.read_json()
+        if req is None:
+            return
+        # Before any monitor is created for the check
+        try:
+            check_id, timestamp, value = parse_point(req)
+        except ValueError, e:
+            s.send_body(400, "application/json", json.dumps({'error': str(e)}))
+            return
+
+        if ingest_queues is None:
+            try:
+                res = push(check_id, value, timestamp, req.get('config', {}))
+            except Exception, e:
+                logger.warn("Could not process point of %s.", check_id, exc_info=True)
+                s.send_body(500, "application/json", json.dumps({'error': str(e)}))
+                return
+            s.send_body(200, "application/json", json.dumps(res))
+            return
+
+        depth = ingest_queues.put(check_id, [(timestamp, value)], req.get('config'))
+        if depth is None:
+            s.send_queue_full({'error': 'Queue full', 'queue_depth': ingest_queues.depth(check_id)})
+            return
+        s.send_body(200, "application/json",
+                    json.dumps({'queued': True, 'queue_depth': depth,
+                                'last': ingest_queues.last_result(check_id)}))
+
+    def do_bulk(s):
+        """ POST /bulk with a JSON array of points, or one point per line
+            (NDJSON). Add ?detail=1 for the result of each point.
+        """
+        varLen = int(s.headers.get('Content-Length', 0))
+        body = s.rfile.read(varLen)
+        try:
+            if body.lstrip().startswith('['):
+                points = json.loads(body)
+            else:
+                points = [json.loads(line) for line in body.splitlines() if line.strip()]
+            if not all(isinstance(point, dict) for point in points):
+                raise ValueError('Points should be objects')
+        except ValueError:
+            s.send_body(400, "application/json", '{"error": "Invalid request"}\n')
+            return
+
+        if ingest_queues is not None:
+            summary = queue_bulk(points)
+            if summary['rejected'] and not summary['queued']:
+                s.send_queue_full(summary)
+            else:
+                s.send_body(200, "application/json", json.dumps(summary))
+            return
+
+        query = urlparse.parse_qs(urlparse.urlparse(s.path).query)
+        detail = query.get('detail', ['0'])[0] not in ('0', 'false', '')
+        s.send_body(200, "application/json", json.dumps(push_bulk(points, detail)))
 
     def do_DELETE(s):
-        varLen = int(s.headers['Content-Length'])
-        postVars = s.rfile.read(varLen)
-        req = json.loads(postVars)
+        req = s.read_json()
+        if req is None:
+            return
         check_id = req['check_id']
-        remove_monitor(check_id)
-        s.send_response(200)
-        s.send_header("Content-type", "application/json")
-        s.end_headers()
-        s.wfile.write('{"result": "OK"}\n')
+        with check_lock(check_id):
+            remove_monitor(check_id)
+        s.send_body(200, "application/json", '{"result": "OK"}\n')
 
 if __name__ == "__main__":
     port = 8080
-    httpd = SocketServer.TCPServer(("", port), MyHandler)
+    httpd = ThreadedHTTPServer(("", port), MyHandler)
     logger.info("Serving at port %d", port)
+    signal.signal(signal.SIGTERM, save_checkpoints)
     gc_task()
+
+    # Optionally, answer pushes at once and process them in worker threads
+    queue_size = int(os.environ.get('INGEST_QUEUE_SIZE', 0))
+    if queue_size:
+        ingest_queues = IngestQueues(push_many, queue_size, int(os.environ.get('INGEST_WORKERS', 4)))
+        logger.info("Queueing up to %d points per check", queue_size)
+
+    # Optionally, also listen for Graphite/statsd lines
+    line_port = int(os.environ.get('LINE_PROTOCOL_PORT', 0))
+    if line_port:
+        line_buffer = LineBuffer(push_many)
+        start_listeners(line_port, line_buffer)
+
     httpd.serve_forever()
@@ -0,0 +1,61 @@
+import heapq
+import logging
+from time import time, sleep
+
+logger = logging.getLogger(__name__)
+
+class Scheduler(object):
+    """ Run many monitors in one process: train each of them, then poll each
+        one every seconds_per_request seconds, always running the task that
+        is due first.
+    """
+
+    def __init__(self, monitors):
+        self.monitors = monitors
+        self._stopped = False
+
+        # Heap of (due time, index of monitor). Every monitor starts by training.
+        now = time()
+        self._queue = [(now, i) for i in range(len(monitors))]
+        heapq.heapify(self._queue)
+
+    def run(self):
+        """ Run due tasks until stopped, then close trained monitors. """
+
+        while self._queue and not self._stopped:
+            due, i = self._queue[0]
+            wait = due - time()
+            if wait > 0:
+                # Wake up at least every second to check if we were stopped
+                sleep(min(wait, 1))
+                continue
+
+            heapq.heappop(self._queue)
+            monitor = self.monitors[i]
+            try:
+                if not monitor.trained:
+                    logger.info("Starting training: %s", monitor.stream.name)
+                    if not monitor.train():
+                        continue
+                    logger.info("Going online: %s", monitor.stream.name)
+                    next_due = time()
+                else:
+                    monitor.poll()
+                    # Keep the pace, unless we are late
+                    next_due = max(due + monitor.seconds_per_request, time())
+            except Exception:
+                logger.error("Error running monitor %s.", monitor.stream.name, exc_info=True)
+                next_due = time() + monitor.seconds_per_request
+            heapq.heappush(self._queue, (next_due, i))
+
+        for monitor in self.monitors:
+            if monitor.trained:
+                monitor.close()
+
+    def stop(self):
+        """ Ask run() to return after the current task. Safe to call from a
+            signal handler.
+        """
+        self._stopped = True
+        for monitor in self.monitors:
+            monitor.stop()
@@ -0,0 +1,81 @@
+import logging
+import threading
+from time import sleep
+from itertools import islice
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# Semaphores limiting concurrent requests per provider, shared by every
+# backfill of the process
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+def _semaphore(provider, concurrency):
+    with _semaphores_lock:
+        if provider not in _semaphores:
+            _semaphores[provider] = threading.BoundedSemaphore(concurrency)
+        return _semaphores[provider]
+
+class Backfill(object):
+    """ Fetch pages of historic data concurrently, with at most concurrency
+        requests at once to provider (for every backfill of the process),
+        retrying failed pages with exponential backoff. Every request waits
+        for limiter (a RateLimiter), if given.
+    """
+
+    def __init__(self, provider, concurrency=4, retries=3, backoff=1, limiter=None):
+        self.provider = provider
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+    def iterate(self, fetch_page, pages, time_key, failed=None):
+        """ Call fetch_page(page) for each page, oldest page first, and yield
+            the points fetched as pages arrive, sorted by point[time_key] and
+            without repeated times. At most concurrency pages are fetched ahead
+            of the one being yielded, so memory is bounded by the page size.
+            Pages that fail after every retry are skipped, and appended to the
+            failed list (if given) before the points of later pages are yielded.
+        """
+        pages = iter(pages)
+        pool = ThreadPool(self.concurrency)
+        try:
+            pending = deque(pool.apply_async(self._fetch, (fetch_page, page))
+                            for page in islice(pages, self.concurrency))
+            last_time = None
+            while pending:
+                page, page_points = pending.popleft().get()
+                for next_page in islice(pages, 1):
+                    pending.append(pool.apply_async(self._fetch, (fetch_page, next_page)))
+                if page_points is None:
+                    if failed is not None:
+                        failed.append(page)
+                    continue
+
+                # Pages may overlap, or come unsorted
+                for point in sorted(page_points, key=lambda point: int(point[time_key])):
+                    if last_time is None or int(point[time_key]) > last_time:
+                        last_time = int(point[time_key])
+                        yield point
+        finally:
+            # Also stops pending fetches if the caller gave up
+            pool.terminate()
+
+    def _fetch(self, fetch_page, page):
+        semaphore = _semaphore(self.provider, self.concurrency)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                sleep(self.backoff * 2 ** (attempt - 1))
+            if self.limiter is not None:
+                self.limiter.acquire()
+            with semaphore:
+                try:
+                    return page, fetch_page(page)
+                except Exception:
+                    logger.warn("Could not fetch %s page %s (attempt %d).",
+                                self.provider, page, attempt + 1, exc_info=True)
+        logger.error("Giving up fetching %s page %s.", self.provider, page)
+        return page, None
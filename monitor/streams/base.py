@@ -1,5 +1,10 @@
 import abc
-from collections import deque
+import numpy as np
+from itertools import islice
+from transforms import build_pipeline, MovingAverage
+from backfill import Backfill
+from cache import get_cache
+from ratelimit import get_rate_limiter
 
 class abstractclassmethod(classmethod):
     """ Decorator for a abstract class method. """
@@ -27,6 +32,11 @@ class BaseStream(object):
         """
         pass
 
+    @property
+    def source(self):
+        """ Name of the stream source, used in reports. """
+        return type(self).__name__
+
     def __init__(self, config):
         # Get stream_id from config
         self.id = config['id']
@@ -37,34 +47,64 @@ class BaseStream(object):
         # Time to keep watch for new values
         self.servertime = 0
 
-        # By default, scaling_factor = 1 and moving_average_window = 1,
-        # which means no transformation
-        self.scaling_factor = config.get('scaling_factor', 1)
-        moving_average_window = config.get('moving_average_window', 1)
-
-        # Deque to keep history of input values for smoothing
-        self.history = deque([0.0] * moving_average_window, maxlen=moving_average_window)
+        # Points missed by new_data (e.g. while stalled) and fetched afterwards
+        self.recovered_points = 0
+
+        # Transforms applied to values before feeding them to NuPIC. By default,
+        # scaling_factor = 1 and moving_average_window = 1, which means no
+        # transformation
+        self.pipeline = build_pipeline(config)
+
+        # Training data to fetch: the last training_window seconds or the last
+        # training_rows points (defaults depend on the stream)
+        self.training_window = config.get('training_window', None)
+        self.training_rows = config.get('training_rows', None)
+
+        # Requests to the provider go through a rate limiter (per account) shared
+        # with every process. Streams without credentials (e.g. pushed data)
+        # don't have one.
+        self.limiter = None
+        if config.get('credentials'):
+            self.limiter = get_rate_limiter(type(self).__name__,
+                                            str(config['credentials'].get('username')),
+                                            rate=config.get('rate_limit', 60),
+                                            burst=config.get('rate_limit_burst', 10),
+                                            redis_config=config.get('redis'))
+
+        # Pages of training data are fetched concurrently
+        self.backfill = Backfill(type(self).__name__,
+                                 concurrency=config.get('backfill_concurrency', 4),
+                                 limiter=self.limiter)
+
+        # Raw points already fetched are cached on disk, if config has a cache_dir
+        self.cache = get_cache(config, type(self).__name__, self.id)
 
     @abc.abstractmethod
     def historic_data(self):
-        """ Return a list of data to be used at training.
+        """ Return an iterable of data to be used at training. Only data newer
+            than self.servertime should be returned, so that restored streams
+            resume where they stopped. Preferably a generator yielding pages as
+            they are fetched, so that training starts before the last page
+            arrives and memory doesn't grow with the training window.
             Should return a structure like this:
                 [{'raw_value': r1, 'value': v1, 'time': t1}, {'raw_value': r1, 'value': v2, 'time': t2}]
             The fields are:
             * 'raw_value': raw value for the metric.
-            * 'value': averaged value (see moving_average) passed to the model.
+            * 'value': transformed value (see transforms.py) passed to the model.
             * 'time': unix timestamp used to compute anomaly likelihood.
         """
         pass
 
     @abc.abstractmethod
     def new_data(self):
-        """ Return a list of new data since last update.
+        """ Return a list of new data since last update. If points were missed
+            since self.servertime, they should be fetched and returned too (in
+            order), counting them in self.recovered_points.
             Should return a structure like this:
                 [{'raw_value': r1, 'value': v1, 'time': t1}, {'raw_value': r1, 'value': v2, 'time': t2}]
             The fields are:
             * 'raw_value': raw value for the metric.
-            * 'value': averaged value (see moving_average) passed to the model.
+            * 'value': transformed value (see transforms.py) passed to the model.
             * 'time': unix timestamp used to compute anomaly likelihood.
         """
         pass
@@ -76,17 +116,79 @@ class BaseStream(object):
         """
         pass
 
-    def _transform(self):
+    def get_state(self):
+        """ Return the state needed to resume this stream (used in checkpoints). """
+
+        return {'servertime': self.servertime,
+                'transforms': self.pipeline.get_state(),
+                'recovered_points': self.recovered_points}
+
+    def set_state(self, state):
+        """ Resume this stream from a state returned by get_state. """
+
+        self.servertime = state['servertime']
+        self.recovered_points = state.get('recovered_points', 0)
+        if 'transforms' in state:
+            self.pipeline.set_state(state['transforms'])
+        elif self.pipeline.stages and isinstance(self.pipeline.stages[0], MovingAverage):
+            # From before transforms were configurable
+            self.pipeline.stages[0].set_state(state['history'])
+
+    def _cache_points(self, points, time_key, failed=()):
+        """ Yield points, adding copies of them to the cache (if any) in
+            batches, before they are changed by the caller. Caching stops once
+            failed (the list of pages that failed, see Backfill.iterate) isn't
+            empty, as the cache is only refreshed after its newest point.
+        """
+        cache = self.cache
+        batch = []
+        for point in points:
+            if cache is not None and failed:
+                self.logger.warn("Pages failed, not caching the points after them.")
+                cache.add(batch, time_key)
+                cache = None
+            if cache is not None:
+                batch.append(dict(point))
+                if len(batch) >= 1000:
+                    cache.add(batch, time_key)
+                    batch = []
+            yield point
+        if cache is not None and batch:
+            cache.add(batch, time_key)
+
+    def _transform_batches(self, points, value_key, time_key, default=None, size=1000):
+        """ Yield points newer than servertime (sorted by point[time_key], in
+            seconds) with 'raw_value', 'value' (transformed) and 'time' (as a
+            datetime) set, as training data. Points without value_key get
+            default. Points are transformed in batches of size with vector
+            operations, instead of one by one.
+        """
+        points = iter(points)
+        while True:
+            chunk = list(islice(points, size))
+            if not chunk:
+                return
+            batch = [point for point in chunk if int(point[time_key]) > self.servertime]
+            if not batch:
+                continue
+            if default is not None:
+                for point in batch:
+                    point.setdefault(value_key, default)
+
+            raw_values = np.array([float(point[value_key]) for point in batch])
+            timestamps = np.array([int(point[time_key]) for point in batch])
+            values = self.pipeline.apply_batch(raw_values, timestamps)
+            times = timestamps.astype('datetime64[s]').astype(object)
+            self.logger.info('Transformed %d points, up to %d.', len(batch), timestamps[-1])
+
+            for point, value, timestamp, time in zip(batch, values.tolist(), timestamps.tolist(), times):
+                point['raw_value'] = point[value_key]
+                point['value'] = value
+                point['time'] = time
+                self.servertime = timestamp
+                yield point
+
+    def _transform(self, value, timestamp):
         """ Used to transform data before feeding it to NuPIC. """
-        # Perform average, if want
-        averaged = self._moving_average()
-
-        # Perform scaling, if want
-        averaged_scaled = averaged*self.scaling_factor
-
-        return averaged_scaled
-
-    def _moving_average(self):
-        """ Used to smooth input data. """
 
-        return sum(self.history)/len(self.history) if len(self.history) > 0 else 0.0
+        return self.pipeline.apply(float(value), timestamp)
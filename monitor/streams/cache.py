@@ -0,0 +1,94 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+from time import time
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+# Layout of a cache directory:
+#   <cache_dir>/<source>/<stream_id>.sqlite
+# with a single table of raw points (as returned by the API) by time.
+SCHEMA = 'CREATE TABLE IF NOT EXISTS points (time INTEGER PRIMARY KEY, data TEXT NOT NULL)'
+
+class PointCache(object):
+    """ On-disk cache of the raw points fetched for a stream, so that training
+        data is only requested once. Connections are opened per call, so the
+        cache can be used from any thread.
+    """
+
+    def __init__(self, cache_dir, source, stream_id, retention=60*60*24*30):
+        # Stream ids are used as file names, so strip anything odd
+        safe_id = re.sub(r'[^\w.-]', '_', str(stream_id))
+        directory = os.path.join(cache_dir, source)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, '%s.sqlite' % safe_id)
+        self.retention = retention
+
+        with closing(self._connect()) as conn:
+            conn.execute(SCHEMA)
+            conn.commit()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def last_time(self):
+        """ Return the time of the newest cached point, or None if empty. """
+
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT MAX(time) FROM points').fetchone()[0]
+
+    def points(self, start=None, last=None):
+        """ Return the list of points yielded by iter_points(). """
+
+        return list(self.iter_points(start, last))
+
+    def iter_points(self, start=None, last=None):
+        """ Yield cached points with time >= start (or all), oldest first. If
+            last is given, only the newest last of them.
+        """
+        query = 'SELECT time, data FROM points WHERE time >= ? ORDER BY time'
+        parameters = (start or 0,)
+        if last is not None:
+            query = 'SELECT * FROM (%s DESC LIMIT ?) ORDER BY time' % query
+            parameters = (start or 0, last)
+
+        with closing(self._connect()) as conn:
+            for _, data in conn.execute(query, parameters):
+                yield json.loads(data)
+
+    def add(self, points, time_key):
+        """ Save points (keyed by int(point[time_key])) and drop the ones older
+            than retention seconds.
+        """
+        if not points:
+            return
+
+        rows = [(int(point[time_key]), json.dumps(point)) for point in points]
+        with closing(self._connect()) as conn:
+            conn.executemany('INSERT OR REPLACE INTO points (time, data) VALUES (?, ?)', rows)
+            conn.execute('DELETE FROM points WHERE time < ?', (int(time()) - self.retention,))
+            conn.commit()
+
+    def delete(self):
+        """ Remove the cache file. """
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def get_cache(config, source, stream_id):
+    """ Return the PointCache for a stream if config has a cache_dir, else None. """
+
+    cache_dir = config.get('cache_dir')
+    if not cache_dir:
+        return None
+    # Keep at least the training window
+    retention = max(60*60*24*30, config.get('training_window') or 0)
+    try:
+        return PointCache(cache_dir, source, stream_id, retention)
+    except Exception:
+        logger.warn("Could not open cache for %s in %s.", stream_id, cache_dir, exc_info=True)
+        return None
@@ -1,12 +1,91 @@
 import librato
 from datetime import datetime
+from itertools import chain
 from base import BaseStream
+from shared import SharedFetch
+from results import get_redis
 import logging
+import threading
 import os
 import time
 
 logger = logging.getLogger(__name__)
 
+class MetricFetcher(object):
+    """ Fetch the last measurements of a metric for every source at once, at
+        most once every max_age seconds for every stream using it. Also caches
+        the metric attributes. With db (a Redis connection), both are shared
+        with every process of the host too.
+    """
+
+    def __init__(self, libr, metric, max_age=30, limiter=None, db=None, credential=''):
+        self.libr = libr
+        self.limiter = limiter
+        self.metric = metric
+        self.max_age = max_age
+        self.shared_attributes = None
+        self.shared_measurements = None
+        if db is not None:
+            key = '%s %s' % (credential, metric)
+            self.shared_attributes = SharedFetch(db, 'librato:attributes', key, max_age=3600)
+            self.shared_measurements = SharedFetch(db, 'librato:measurements', key, max_age=max_age)
+        self._attributes = None
+        self._measurements = {}
+        self._fetched = 0
+        self._lock = threading.Lock()
+
+    def attributes(self):
+        """ Return the metric attributes (e.g. display_units_short). """
+
+        with self._lock:
+            if self._attributes is None:
+                if self.shared_attributes is not None:
+                    self._attributes = self.shared_attributes.get(self._fetch_attributes, self._acquire)[0]
+                else:
+                    self._acquire()
+                    self._attributes = self._fetch_attributes()
+            return self._attributes
+
+    def measurements(self):
+        """ Return dict with the last measurements of each source. """
+
+        with self._lock:
+            if time.time() - self._fetched >= self.max_age:
+                if self.shared_measurements is not None:
+                    self._measurements, self._fetched = self.shared_measurements.get(self._fetch_measurements,
+                                                                                     self._acquire)
+                else:
+                    self._acquire()
+                    self._measurements, self._fetched = self._fetch_measurements(), time.time()
+            return self._measurements
+
+    def _acquire(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def _fetch_attributes(self):
+        return self.libr.get(self.metric, count=1, resolution=1).attributes
+
+    def _fetch_measurements(self):
+        return self.libr.get(self.metric, count=5, resolution=60).measurements
+
+# Fetchers shared by streams of the process, by credentials and metric
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+def get_metric_fetcher(credentials, metric, limiter=None, redis_config=None):
+    """ Return the MetricFetcher of the process for credentials and metric,
+        sharing what it fetches with other processes through Redis.
+    """
+    key = (credentials['username'], credentials['token'], metric)
+    with _fetchers_lock:
+        if key not in _fetchers:
+            libr = librato.connect(credentials['username'], credentials['token'])
+            _fetchers[key] = MetricFetcher(libr, metric, limiter=limiter,
+                                           db=get_redis(**(redis_config or {})),
+                                           credential='%s %s' % key[:2])
+        return _fetchers[key]
+
 class LibratometricsStream(BaseStream):
     """ Class to provide a stream of data to NuPIC. """
 
@@ -29,12 +108,16 @@ class LibratometricsStream(BaseStream):
         # Set metric to use
         self.metric = config['metric']
 
+        # Shared with every stream of the same metric and credentials
+        self.fetcher = get_metric_fetcher(config['credentials'], self.metric, self.limiter,
+                                          config.get('redis'))
+
         # Get unit
-        self._value_unit = self.libr.get(self.metric, count=1, resolution=1).attributes.get('display_units_short', 'u')
+        self._value_unit = self.fetcher.attributes().get('display_units_short', 'u')
         self._value_label = self.metric
 
-        # Setup logging
-        self.logger =  logger or logging.getLogger(__name__)
+        # Setup logging (a logger per stream, as a process may host many)
+        self.logger = logger.getChild(self.name.replace('.', '_'))
         handler = logging.handlers.RotatingFileHandler(os.environ['LOG_DIR']+"/stream_%s.log" % self.name,
                                                        maxBytes=1024*1024,
                                                        backupCount=4,
@@ -46,43 +129,40 @@ class LibratometricsStream(BaseStream):
         self.logger.setLevel(logging.INFO)
 
     def historic_data(self):
-        """ Return a batch of data to be used at training """
+        """ Yield data to be used at training, as it is fetched """
 
+        # Defaults to the last 3 days
+        if self.training_window is not None:
+            window = self.training_window
+        elif self.training_rows is not None:
+            window = self.training_rows*60
+        else:
+            window = 60*60*24*3
+
+        # Cached points are only fetched again if newer
         time_now = int(time.time())
-        time_start = time_now - 60*60*24*3
-        historic_data = []
-        while time_start < time_now:
-            try:
-                metric_results = self.libr.get(self.metric, start_time=time_start, count=100, resolution=60, source=self.id)
-                measurements = metric_results.measurements[self.id]
-            except Exception:
-                logger.warn("Could not get Librato AWS CPU results.", exc_info=True)
-                continue
-
-            for model_input in measurements:
-                if  self.servertime < model_input['measure_time']:
-                    self.servertime  = model_input['measure_time']
-                    model_input['time'] = datetime.utcfromtimestamp(self.servertime)
-
-                    self.history.appendleft(float(model_input['value']))
-                    model_input['raw_value'] = model_input['value']
-                    model_input['value'] = self._transform()
-                    self.logger.info('Raw value: %f\tTransformed: %f', model_input['raw_value'], model_input['value'])
-                    historic_data.append(model_input)
-            time_start = time_start + 100*60
-
-        return historic_data
+        time_start = max(time_now - window, self.servertime)
+        cached = []
+        last_cached = self.cache.last_time() if self.cache else None
+        if last_cached is not None:
+            cached = self.cache.iter_points(time_start)
+            time_start = max(time_start, last_cached + 1)
+
+        failed = []
+        measurements = chain(cached, self._cache_points(self._fetch_range(time_start, time_now, failed),
+                                                        'measure_time', failed))
+        return self._transform_batches(measurements, 'value', 'measure_time')
 
     def new_data(self):
         """ Return list of new data points since last fetching. """
 
         self.logger.info("Server time before processing results: %d", self.servertime)
 
-        # Fetch last 5 results
+        # Fetch last 5 results (fetched at once for every source, so copy them
+        # before changing)
         new_data = []
         try:
-            cpu = self.libr.get(self.metric, count=5, resolution=60, source=self.id)
-            librato_results = cpu.measurements[self.id]
+            librato_results = [dict(r) for r in self.fetcher.measurements().get(self.id, [])]
         except Exception:
             self.logger.warn("Could not get Librato AWS CPU results.", exc_info=True)
             return new_data
@@ -92,17 +172,29 @@ class LibratometricsStream(BaseStream):
         self.logger.info("\t%12s%12s", "time", "raw_value")
         for r in librato_results[-5::1]:
             self.logger.info("\t%12d%12.3f", r['measure_time'], r['value'])
+        librato_results = librato_results[-5::1]
+
+        # If points were missed since servertime (more than the last 5 results),
+        # fetch them too
+        if self.servertime > 0 and librato_results:
+            oldest = min(r['measure_time'] for r in librato_results)
+            if oldest - self.servertime > 1.5*60:
+                self.logger.info("Missed results since %d, backfilling.", self.servertime)
+                missed = list(self._fetch_range(self.servertime + 1, oldest - 1))
+                recovered = len([r for r in missed if r['measure_time'] > self.servertime])
+                self.recovered_points += recovered
+                self.logger.info("Recovered %d results (%d in total).", recovered, self.recovered_points)
+                librato_results = missed + librato_results
 
         # If any result contains new responses (ahead of [servetime]) process it.
         # We check the last 5 results, so that we don't many lose data points.
-        for model_input in librato_results[-5::1]:
+        for model_input in librato_results:
             if self.servertime < model_input['measure_time']:
                 self.servertime  = model_input['measure_time']
                 model_input['time'] = datetime.utcfromtimestamp(self.servertime)
 
-                self.history.appendleft(float(model_input['value']))
                 model_input['raw_value'] = model_input['value']
-                model_input['value'] = self._transform()
+                model_input['value'] = self._transform(model_input['value'], self.servertime)
 
                 self.logger.info('Raw value: %f\tTransformed: %f', model_input['raw_value'], model_input['value'])
 
@@ -112,6 +204,20 @@ class LibratometricsStream(BaseStream):
         self.logger.info("New data: %s", new_data)
         return new_data
 
+    def _fetch_range(self, start, end, failed=None):
+        """ Yield the points from start to end (inclusive), oldest first, as
+            they are fetched concurrently in pages of 100 points of 1 minute.
+            Pages that failed are appended to failed.
+        """
+        pages = [(t, min(t + 100*60 - 1, end)) for t in range(start, end + 1, 100*60)]
+
+        def fetch_page(page):
+            metric_results = self.libr.get(self.metric, start_time=page[0], end_time=page[1],
+                                           count=100, resolution=60, source=self.id)
+            return metric_results.measurements.get(self.id, [])
+
+        return self.backfill.iterate(fetch_page, pages, 'measure_time', failed)
+
     @classmethod
     def available_streams(cls, data):
         """ Return a list with available streams for the class implementing this. Should return a list :
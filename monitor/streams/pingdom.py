@@ -1,12 +1,68 @@
 from utils import pingdom # Pingdom API wrapper
 from datetime import datetime
 from collections import deque
+from itertools import chain
 from base import BaseStream
+from shared import SharedFetch
+from results import get_redis
 import logging
+import threading
+import time
 import os
 
 logger = logging.getLogger(__name__)
 
+class ChecksPoller(object):
+    """ Fetch the list of checks, with the last result of each one, at most
+        once every max_age seconds for every stream using it. With shared (a
+        SharedFetch), also for every process of the host.
+    """
+
+    def __init__(self, ping, max_age=30, limiter=None, shared=None):
+        self.ping = ping
+        self.limiter = limiter
+        self.shared = shared
+        self.max_age = max_age
+        self._checks = {}
+        self._fetched = 0
+        self._lock = threading.Lock()
+
+    def checks(self):
+        """ Return dict with the checks by id (as string). """
+
+        with self._lock:
+            if time.time() - self._fetched >= self.max_age:
+                if self.shared is not None:
+                    checks, self._fetched = self.shared.get(self._fetch, self._acquire)
+                else:
+                    self._acquire()
+                    checks, self._fetched = self._fetch(), time.time()
+                self._checks = dict((str(check['id']), check) for check in checks)
+            return self._checks
+
+    def _acquire(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def _fetch(self):
+        # The client cache may be older than max_age
+        return self.ping.method('checks', cache=False)['checks']
+
+# Pollers shared by streams of the process, by credentials
+_checks_pollers = {}
+_checks_pollers_lock = threading.Lock()
+
+def get_checks_poller(ping, credentials, limiter=None, redis_config=None):
+    """ Return the ChecksPoller of the process for credentials, sharing the
+        checks with other processes through Redis.
+    """
+    key = (credentials['username'], credentials['appkey'])
+    with _checks_pollers_lock:
+        if key not in _checks_pollers:
+            shared = SharedFetch(get_redis(**(redis_config or {})), 'pingdom:checks', '%s %s' % key)
+            _checks_pollers[key] = ChecksPoller(ping, limiter=limiter, shared=shared)
+        return _checks_pollers[key]
+
 class PingdomStream(BaseStream):
     """ Class to provide a stream of data to NuPIC. """
 
@@ -27,11 +83,15 @@ class PingdomStream(BaseStream):
                                     password=config['credentials']['password'],
                                     appkey=config['credentials']['appkey'])
 
+        # Shared with every stream with the same credentials
+        self.checks_poller = get_checks_poller(self.ping, config['credentials'], self.limiter,
+                                               config.get('redis'))
+
         # Default value to associate with timeouts (to have something to feed NuPIC)
         self.timeout_default = 30000
 
-        # Setup logging
-        self.logger =  logger or logging.getLogger(__name__)
+        # Setup logging (a logger per stream, as a process may host many)
+        self.logger = logger.getChild(self.name.replace('.', '_'))
         handler = logging.handlers.RotatingFileHandler(os.environ['LOG_DIR']+"/stream_%s.log" % self.name,
                                                        maxBytes=1024*1024,
                                                        backupCount=4,
@@ -43,39 +103,40 @@ class PingdomStream(BaseStream):
         self.logger.setLevel(logging.INFO)
 
     def historic_data(self):
-        """ Return a batch of data to be used at training """
-
-        # Get past resuts for stream
-        results = deque()
-        i = 0
-        while i < 1:
-            try:
-                pingdomResult = self.ping.method('results/%s/' % self.id, method='GET', parameters={'limit': 1000, 'offset': i*1000})
-            except Exception:
-                self.logger.warn("Could not get Pingdom results.", exc_info=True)
-                i = i + 1
-                continue
-            for result in pingdomResult['results']:
-                results.appendleft(result)
-            i = i + 1
-
-        historic_data = []
-        for model_input in results:
-            # If dont' have response time is because it's not up, so set it to a large number
-            if 'responsetime' not in model_input:
-                model_input['responsetime'] = self.timeout_default
-
-            self.history.appendleft(float(model_input['responsetime']))
-            model_input['raw_value'] = model_input['responsetime']
-            model_input['value'] = self._transform()
-            self.logger.info('Raw value: %f\tTransformed: %f', model_input['raw_value'], model_input['value'])
-
-            self.servertime  = int(model_input['time'])
-            model_input['time'] = datetime.utcfromtimestamp(self.servertime)
-
-            historic_data.append(model_input)
-
-        return historic_data
+        """ Yield data to be used at training, as it is fetched """
+
+        # Get past resuts for stream (only newer than servertime, if resuming),
+        # in pages fetched concurrently: by time, if given a training_window,
+        # resuming or with cached results, else the last training_rows results
+        # (defaults to 1000). Cached results are only fetched again if newer.
+        rows = self.training_rows or 1000
+        time_now = int(time.time())
+        last_cached = self.cache.last_time() if self.cache else None
+        cached = []
+        if self.training_window is not None or self.servertime > 0 or last_cached is not None:
+            if self.training_window is not None:
+                window = self.training_window
+            else:
+                # Enough time for rows results at the check's interval (with
+                # some room for missing ones), trimmed to the last rows below
+                window = int(rows*self._interval()*1.1)
+            time_start = max(time_now - window, self.servertime + 1)
+            if last_cached is not None:
+                cached = self.cache.iter_points(time_start)
+                time_start = max(time_start, last_cached + 1)
+            pages = self._time_pages(time_start, time_now)
+        else:
+            # Newest results come first, so start from the last page
+            pages = [{'limit': min(1000, rows - offset), 'offset': offset}
+                     for offset in range(0, rows, 1000)][::-1]
+
+        # If dont' have response time is because it's not up, so set it to a large number
+        failed = []
+        results = chain(cached, self._cache_points(self._fetch_results(pages, failed), 'time', failed))
+        if self.training_window is None and self.servertime == 0:
+            # Only the last rows results, as by offset
+            results = deque(results, maxlen=rows)
+        return self._transform_batches(results, 'responsetime', 'time', default=self.timeout_default)
 
     def new_data(self):
         """ Return list of new data points since last fetching. """
@@ -84,14 +145,13 @@ class PingdomStream(BaseStream):
 
         new_data = []
         try:
-            pingdom_results = self.ping.method('results/%s/' % self.id, method='GET', parameters={'limit': 5})['results']
+            pingdom_results = self._last_results()
         except Exception:
             self.logger.warn("Could not get Pingdom results.", exc_info=True)
             return new_data
 
         # If any result contains new responses (ahead of [servetime]) process it.
-        # We check the last 5 results, so that we don't many lose data points.
-        for model_input in pingdom_results[4::-1]:
+        for model_input in pingdom_results:
             if self.servertime < int(model_input['time']):
                 # Update servertime
                 self.servertime  = int(model_input['time'])
@@ -101,9 +161,8 @@ class PingdomStream(BaseStream):
                 if 'responsetime' not in model_input:
                     model_input['responsetime'] = self.timeout_default
 
-                self.history.appendleft(float(model_input['responsetime']))
                 model_input['raw_value'] = model_input['responsetime']
-                model_input['value'] = self._transform()
+                model_input['value'] = self._transform(model_input['responsetime'], self.servertime)
                 self.logger.info('Raw value: %f\tTransformed: %f', model_input['raw_value'], model_input['value'])
 
                 new_data.append(model_input)
@@ -112,6 +171,63 @@ class PingdomStream(BaseStream):
         self.logger.info("New data: %s", new_data)
         return new_data
 
+    def _last_results(self):
+        """ Return results newer than servertime, oldest first. The last result
+            of the check comes from the checks list shared by every stream with
+            the same credentials, so a cycle costs one API call for all of them.
+            If results were missed since servertime, they are fetched with the
+            results endpoint.
+        """
+        check = self.checks_poller.checks().get(self.id)
+        if check is None or 'lasttesttime' not in check:
+            return []
+
+        last_time = int(check['lasttesttime'])
+        if last_time <= self.servertime:
+            return []
+
+        # Check interval in seconds (resolution is in minutes)
+        interval = int(check.get('resolution', 1))*60
+        if self.servertime > 0 and last_time - self.servertime > 1.5*interval:
+            self.logger.info("Missed results since %d, backfilling.", self.servertime)
+            results = list(self._fetch_results(self._time_pages(self.servertime + 1, last_time)))
+            recovered = len([r for r in results if self.servertime < int(r['time']) < last_time])
+            self.recovered_points += recovered
+            self.logger.info("Recovered %d results (%d in total).", recovered, self.recovered_points)
+            return results
+
+        result = {'time': last_time, 'status': check['status']}
+        if check['status'] == 'up' and 'lastresponsetime' in check:
+            result['responsetime'] = check['lastresponsetime']
+        return [result]
+
+    def _interval(self):
+        """ Return the seconds between results of the check (1 minute if unknown). """
+
+        try:
+            check = self.checks_poller.checks().get(self.id) or {}
+        except Exception:
+            self.logger.warn("Could not get the check interval.", exc_info=True)
+            check = {}
+        return int(check.get('resolution', 1))*60
+
+    def _time_pages(self, start, end):
+        """ Parameters to fetch results from start to end (inclusive) in pages. """
+
+        # At most 1000 results per page, with checks every minute
+        return [{'from': t, 'to': min(t + 1000*60 - 1, end), 'limit': 1000}
+                for t in range(start, end + 1, 1000*60)]
+
+    def _fetch_results(self, pages, failed=None):
+        """ Fetch pages (oldest first) of results concurrently. Yield the
+            results, oldest first, as they arrive. Pages that failed are
+            appended to failed.
+        """
+        def fetch_page(parameters):
+            return self.ping.method('results/%s/' % self.id, method='GET', parameters=parameters)['results']
+
+        return self.backfill.iterate(fetch_page, pages, 'time', failed)
+
     @classmethod
     def available_streams(cls, data):
         """ Return a list with available streams for the class implementing this. Should return a list :
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import threading
+from time import time, sleep
+from results import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Token bucket kept in a Redis hash, so that every process using the same
+# provider and credentials shares it. Takes a token if there is one and
+# returns 0, else returns the seconds to wait for one (as a string, as Lua
+# numbers are truncated to integers in replies).
+#   KEYS[1]: bucket key
+#   ARGV: rate (tokens per second), burst (bucket size), now
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'time', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+class RateLimiter(object):
+    """ Limit requests to a provider to rate per minute (with bursts of up to
+        burst requests), for every process of the host sharing Redis. Requests
+        over the budget wait for it instead of failing.
+
+        Besides the bucket at 'ratelimit:<provider>:<hash of credentials>',
+        totals of requests, requests that waited and seconds waited are kept
+        in the 'ratelimit:stats:<provider>:<hash of credentials>' hash.
+    """
+
+    def __init__(self, db, provider, credential, rate=60, burst=10):
+        self.db = db
+        self.provider = provider
+        self.rate = rate / 60.0
+        self.burst = burst
+        digest = hashlib.md5(credential).hexdigest()
+        self.key = 'ratelimit:%s:%s' % (provider, digest)
+        self.stats_key = 'ratelimit:stats:%s:%s' % (provider, digest)
+        self.script = db.register_script(TOKEN_BUCKET)
+
+    def acquire(self):
+        """ Wait until a request can be made. Return the seconds waited. """
+
+        waited = 0
+        while True:
+            try:
+                wait = float(self.script(keys=[self.key], args=[self.rate, self.burst, time()]))
+            except Exception:
+                # Better to risk throttling than to stop fetching
+                logger.warn("Could not check %s rate limit.", self.provider, exc_info=True)
+                return waited
+            if wait <= 0:
+                break
+            sleep(wait)
+            waited += wait
+
+        try:
+            pipe = self.db.pipeline()
+            pipe.hincrby(self.stats_key, 'requests', 1)
+            if waited > 0:
+                pipe.hincrby(self.stats_key, 'waited', 1)
+                pipe.hincrbyfloat(self.stats_key, 'wait_seconds', waited)
+            pipe.execute()
+        except Exception:
+            logger.warn("Could not update %s rate limit stats.", self.provider, exc_info=True)
+
+        if waited > 0:
+            logger.info("Waited %.2f seconds for %s rate limit.", waited, self.provider)
+        return waited
+
+    def usage(self):
+        """ Return dict with the stats and the tokens left in the bucket. """
+
+        stats = self.db.hgetall(self.stats_key)
+        tokens = self.db.hget(self.key, 'tokens')
+        return {'requests': int(stats.get('requests', 0)),
+                'waited': int(stats.get('waited', 0)),
+                'wait_seconds': float(stats.get('wait_seconds', 0)),
+                'tokens': float(tokens) if tokens is not None else float(self.burst),
+                'burst': self.burst}
+
+# Rate limiters of the process, by provider, credentials and Redis settings
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider, credential, rate=60, burst=10, redis_config=None):
+    """ Return the RateLimiter of the process for provider and credential. """
+
+    redis_config = redis_config or {}
+    key = (provider, credential, tuple(sorted(redis_config.items())))
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(get_redis(**redis_config), provider, credential, rate, burst)
+        return _limiters[key]
@@ -0,0 +1,94 @@
+import json
+import hashlib
+import logging
+from time import time, sleep
+
+logger = logging.getLogger(__name__)
+
+class SharedFetch(object):
+    """ Share a value fetched from a provider between every process of the
+        host, through Redis: fetch() (returning something JSON serializable)
+        is called at most once every max_age seconds by one process, which
+        holds a lock (for at most wait seconds) meanwhile, and the others read
+        its result from 'shared:<name>:<hash of key>'. If Redis fails, fetch()
+        is called.
+    """
+
+    def __init__(self, db, name, key, max_age=30, wait=60):
+        self.db = db
+        self.max_age = max_age
+        self.wait = wait
+        self.key = 'shared:%s:%s' % (name, hashlib.md5(key).hexdigest())
+        self.lock_key = self.key + ':lock'
+
+    def get(self, fetch, prepare=None):
+        """ Return (value, time it was fetched), calling fetch() if the shared
+            value is too old. prepare() (e.g. waiting for a rate limit) is
+            called before taking the lock to fetch, and before any fetch, so
+            the lock is only held while fetching.
+        """
+        prepared = []
+        try:
+            shared, locked = self._wait(prepare, prepared)
+        except Exception:
+            logger.warn("Could not read shared %s.", self.key, exc_info=True)
+            shared, locked = None, False
+        if shared is not None:
+            return shared['value'], shared['time']
+
+        if prepare is not None and not prepared:
+            prepare()
+        try:
+            value = fetch()
+        except Exception:
+            self._unlock(locked)
+            raise
+        fetched = time()
+        try:
+            if locked:
+                self.db.set(self.key, json.dumps({'time': fetched, 'value': value}), ex=self.max_age)
+        except Exception:
+            logger.warn("Could not save shared %s.", self.key, exc_info=True)
+        self._unlock(locked)
+        return value, fetched
+
+    def _unlock(self, locked):
+        if not locked:
+            return
+        try:
+            self.db.delete(self.lock_key)
+        except Exception:
+            logger.warn("Could not release lock of %s.", self.key, exc_info=True)
+
+    def _wait(self, prepare, prepared):
+        """ Return (shared, False) if a recent value is shared (or comes while
+            another process fetches it), else (None, whether we took the lock
+            to fetch it). Calls prepare() before trying the lock, appending
+            to prepared once it did.
+        """
+        deadline = time() + self.wait
+        while True:
+            shared = self._read()
+            if shared is not None:
+                return shared, False
+            if prepare is not None and not prepared:
+                prepare()
+                prepared.append(True)
+                # It may have been fetched meanwhile
+                deadline = time() + self.wait
+                continue
+            if self.db.set(self.lock_key, 1, ex=self.wait, nx=True):
+                return None, True
+            if time() > deadline:
+                logger.warn("Timed out waiting for shared %s.", self.key)
+                return None, False
+            sleep(0.1)
+
+    def _read(self):
+        data = self.db.get(self.key)
+        if data is None:
+            return None
+        data = json.loads(data)
+        if time() - data['time'] >= self.max_age:
+            return None
+        return data
@@ -0,0 +1,356 @@
+import math
+import bisect
+import numpy as np
+from collections import deque
+
+# Transforms applied to each value before feeding it to NuPIC, configured in
+# the 'parameters' block as a list of stages, applied in order. Each item is
+# the name of a stage, or a dict with its name and argument:
+#     transforms:
+#         - moving_average: 10   # Mean of the last 10 values
+#         - ewma: 0.3            # Exponentially weighted mean, with alpha 0.3
+#         - rolling_median: 5    # Median of the last 5 values
+#         - rate                 # Change per second from the previous value
+#         - clip: [0, 30000]     # Limit to [min, max] (either can be null)
+#         - log                  # log(1 + value), negatives taken as 0
+#         - scale: 0.001         # Multiply by a factor
+# Every stage takes O(1) per value (rolling_median takes O(window), which is
+# meant to be small), and keeps a state that can be checkpointed. Batches of
+# values (e.g. training data) can also be transformed at once with NumPy.
+
+class Stage(object):
+    """ Base class of transform stages. """
+
+    def apply(self, value, timestamp):
+        """ Return the transformed value. timestamp is in seconds. """
+        raise NotImplementedError
+
+    def apply_batch(self, values, timestamps):
+        """ Return the transformed values (arrays), as apply would one by one. """
+
+        return np.array([self.apply(value, timestamp) for value, timestamp in zip(values, timestamps)],
+                        dtype=float)
+
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+class MovingAverage(Stage):
+    """ Mean of the last window values, with a running sum. Starts with a
+        window of zeros, as the original moving average did.
+    """
+
+    def __init__(self, window):
+        self.window = deque([0.0] * window, maxlen=window)
+        self.total = 0.0
+        self._updates = 0
+
+    def apply(self, value, timestamp):
+        self.total += value - self.window[-1]
+        self.window.appendleft(value)
+
+        # Avoid accumulating float errors (amortized O(1))
+        self._updates += 1
+        if self._updates >= self.window.maxlen:
+            self.total = sum(self.window)
+            self._updates = 0
+
+        return self.total / self.window.maxlen
+
+    def apply_batch(self, values, timestamps):
+        size = self.window.maxlen
+        # Previous window (oldest first) followed by the values
+        series = np.concatenate((np.array(self.window, dtype=float)[::-1], values))
+        sums = np.concatenate(([0.0], np.cumsum(series)))
+        means = (sums[size + 1:] - sums[1:len(values) + 1]) / size
+
+        self.window = deque(series[::-1][:size].tolist(), maxlen=size)
+        self.total = sum(self.window)
+        self._updates = 0
+        return means
+
+    def get_state(self):
+        return list(self.window)
+
+    def set_state(self, state):
+        # Keep the configured window, even if it changed since the checkpoint
+        self.window = deque(state, maxlen=self.window.maxlen)
+        while len(self.window) < self.window.maxlen:
+            self.window.append(0.0)
+        self.total = sum(self.window)
+
+class EWMA(Stage):
+    """ Exponentially weighted moving average. """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.mean = None
+
+    def apply(self, value, timestamp):
+        if self.mean is None:
+            self.mean = value
+        else:
+            self.mean += self.alpha * (value - self.mean)
+        return self.mean
+
+    def get_state(self):
+        return self.mean
+
+    def set_state(self, state):
+        self.mean = state
+
+class RollingMedian(Stage):
+    """ Median of the last window values. """
+
+    def __init__(self, window):
+        self.size = window
+        self.values = deque()
+        self.sorted = []
+
+    def apply(self, value, timestamp):
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+        if len(self.values) > self.size:
+            old = self.values.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+
+        n = len(self.sorted)
+        if n % 2:
+            return self.sorted[n // 2]
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2.0
+
+    def get_state(self):
+        return list(self.values)
+
+    def set_state(self, state):
+        self.values = deque(state[-self.size:])
+        self.sorted = sorted(self.values)
+
+class Rate(Stage):
+    """ Change per second since the previous value (0 for the first one). """
+
+    def __init__(self):
+        self.last = None
+
+    def apply(self, value, timestamp):
+        rate = 0.0
+        if self.last is not None and timestamp > self.last[1]:
+            rate = (value - self.last[0]) / float(timestamp - self.last[1])
+        self.last = (value, timestamp)
+        return rate
+
+    def apply_batch(self, values, timestamps):
+        if len(values) == 0:
+            return values
+        timestamps = np.asarray(timestamps, dtype=float)
+        last = self.last if self.last is not None else (values[0], np.inf)
+        deltas = np.diff(np.concatenate(([last[0]], values)))
+        intervals = np.diff(np.concatenate(([last[1]], timestamps)))
+        rates = np.zeros(len(values))
+        forward = intervals > 0
+        rates[forward] = deltas[forward] / intervals[forward]
+
+        self.last = (float(values[-1]), int(timestamps[-1]))
+        return rates
+
+    def get_state(self):
+        return self.last
+
+    def set_state(self, state):
+        self.last = tuple(state) if state is not None else None
+
+class Clip(Stage):
+    """ Limit values to [minimum, maximum] (None for no limit). """
+
+    def __init__(self, limits):
+        self.minimum, self.maximum = limits
+
+    def apply(self, value, timestamp):
+        if self.minimum is not None:
+            value = max(value, self.minimum)
+        if self.maximum is not None:
+            value = min(value, self.maximum)
+        return value
+
+    def apply_batch(self, values, timestamps):
+        if self.minimum is not None:
+            values = np.maximum(values, self.minimum)
+        if self.maximum is not None:
+            values = np.minimum(values, self.maximum)
+        return values
+
+class Log(Stage):
+    """ log(1 + value), with negative values taken as 0. """
+
+    def apply(self, value, timestamp):
+        return math.log1p(max(value, 0.0))
+
+    def apply_batch(self, values, timestamps):
+        return np.log1p(np.maximum(values, 0.0))
+
+class Scale(Stage):
+    """ Multiply values by a factor. """
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def apply(self, value, timestamp):
+        return value * self.factor
+
+    def apply_batch(self, values, timestamps):
+        return values * self.factor
+
+# Name in the configuration -> (stage class, whether it takes an argument)
+STAGES = {'moving_average': (MovingAverage, True),
+          'ewma': (EWMA, True),
+          'rolling_median': (RollingMedian, True),
+          'rate': (Rate, False),
+          'clip': (Clip, True),
+          'log': (Log, False),
+          'scale': (Scale, True)}
+
+class Pipeline(object):
+    """ Chain of transform stages. """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def apply(self, value, timestamp):
+        """ Return value (at timestamp, in seconds) after every stage. """
+
+        for stage in self.stages:
+            value = stage.apply(value, timestamp)
+        return value
+
+    def apply_batch(self, values, timestamps):
+        """ Return array of values (at timestamps, in seconds) after every
+            stage, computed with vector operations where stages allow it.
+        """
+        values = np.asarray(values, dtype=float)
+        for stage in self.stages:
+            values = stage.apply_batch(values, timestamps)
+        return values
+
+    def get_state(self):
+        return [stage.get_state() for stage in self.stages]
+
+    def set_state(self, state):
+        # Ignore states of another configuration
+        if len(state) != len(self.stages):
+            return
+        for stage, stage_state in zip(self.stages, state):
+            stage.set_state(stage_state)
+
+# Aggregations of the values of a time bucket
+AGGREGATIONS = ('mean', 'max', 'last', 'count')
+
+class TimeBuckets(object):
+    """ Fold values into buckets of seconds (aligned to multiples of seconds),
+        aggregated by method (one of AGGREGATIONS). A bucket closes when a
+        value of a later bucket comes; values older than the open bucket are
+        folded into it. Buckets without values are skipped.
+    """
+
+    def __init__(self, seconds, method='mean'):
+        self.seconds = seconds
+        self.method = method
+        self.bucket = None # [start, count, total, maximum, last] of the open bucket
+
+    def add(self, value, timestamp):
+        """ Add value at timestamp (in seconds). Return list of (start, value)
+            of the buckets it closed (none or one).
+        """
+        start = int(timestamp) // self.seconds * self.seconds
+        closed = []
+        if self.bucket is not None and start > self.bucket[0]:
+            closed.append((self.bucket[0], self.value()))
+            self.bucket = None
+
+        if self.bucket is None:
+            self.bucket = [start, 1, value, value, value]
+        else:
+            self.bucket[1] += 1
+            self.bucket[2] += value
+            self.bucket[3] = max(self.bucket[3], value)
+            self.bucket[4] = value
+        return closed
+
+    def value(self):
+        """ Return the aggregated value of the open bucket. """
+
+        _, count, total, maximum, last = self.bucket
+        if self.method == 'mean':
+            return total / count
+        if self.method == 'max':
+            return maximum
+        if self.method == 'last':
+            return last
+        return float(count)
+
+    def get_state(self):
+        return self.bucket
+
+    def set_state(self, state):
+        self.bucket = list(state) if state is not None else None
+
+def build_buckets(config):
+    """ Return the TimeBuckets for config's bucket_seconds and
+        bucket_aggregation (default 'mean'), or None without bucket_seconds.
+        Raise ValueError for invalid values.
+    """
+    seconds = config.get('bucket_seconds')
+    if not seconds:
+        return None
+    if not isinstance(seconds, (int, long)) or seconds < 1:
+        raise ValueError('Bucket seconds should be a positive integer.')
+    method = config.get('bucket_aggregation', 'mean')
+    if method not in AGGREGATIONS:
+        raise ValueError('Bucket aggregation should be one of %s.' % ', '.join(AGGREGATIONS))
+    return TimeBuckets(seconds, method)
+
+def _stage(item):
+    """ Return the stage for an item of the transforms list. """
+
+    if isinstance(item, dict):
+        if len(item) != 1:
+            raise ValueError('Transform %s should have a single name.' % item)
+        name, argument = item.items()[0]
+    else:
+        name, argument = item, None
+
+    if name not in STAGES:
+        raise ValueError('Unknown transform %s.' % name)
+    cls, takes_argument = STAGES[name]
+    if not takes_argument:
+        return cls()
+    if argument is None:
+        raise ValueError('Transform %s needs an argument.' % name)
+
+    if name in ('moving_average', 'rolling_median'):
+        if not isinstance(argument, (int, long)) or argument < 1:
+            raise ValueError('Window of %s should be a positive integer.' % name)
+    elif name == 'ewma':
+        if not isinstance(argument, (float, int, long)) or not 0 < argument <= 1:
+            raise ValueError('Alpha of ewma should be in (0, 1].')
+    elif name == 'clip':
+        if not isinstance(argument, (list, tuple)) or len(argument) != 2:
+            raise ValueError('Clip takes a list with [min, max].')
+    elif not isinstance(argument, (float, int, long)):
+        raise ValueError('Factor of scale should be a number.')
+    return cls(argument)
+
+def build_pipeline(config):
+    """ Return the Pipeline for config's 'transforms' list. Without it, a
+        moving average of moving_average_window values (default 1) scaled by
+        scaling_factor (default 1), as before transforms were configurable.
+        Raise ValueError for invalid transforms.
+    """
+    transforms = config.get('transforms')
+    if transforms is None:
+        transforms = [{'moving_average': int(config.get('moving_average_window', 1))},
+                      {'scale': float(config.get('scaling_factor', 1))}]
+    if not isinstance(transforms, list):
+        raise ValueError('Transforms should be a list.')
+    return Pipeline([_stage(item) for item in transforms])
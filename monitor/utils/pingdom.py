@@ -21,49 +21,63 @@
 # THE SOFTWARE.
 
 from urlparse import urljoin
-from urllib import urlencode
-import urllib2
-import json
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import copy
 import time
 
 API_URL = 'https://api.pingdom.com/api/2.0/'
 
+# GET endpoints whose responses are cached for cache_ttl seconds
+CACHED_ENDPOINTS = ('checks',)
+
 class Pingdom(object):
-    def __init__(self, url=API_URL, username=None, password=None, appkey=None):
+    def __init__(self, url=API_URL, username=None, password=None, appkey=None,
+                 timeout=30, cache_ttl=60):
         self.url = url
         self.appkey= appkey
-        password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        password_manager.add_password(None, url, username, password)
-        auth_handler = urllib2.HTTPBasicAuthHandler(password_manager)
-        self.opener = urllib2.build_opener(auth_handler)
-        
-    class RequestWithMethod(urllib2.Request):
-        def __init__(self, url, data=None, headers={},
-                     origin_req_host=None, unverifiable=False, http_method=None):
-           urllib2.Request.__init__(self, url, data, headers, origin_req_host, unverifiable)
-           if http_method:
-               self.method = http_method
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
 
-        def get_method(self):
-            if self.method:
-                return self.method
-            return urllib2.Request.get_method(self)
-    
-    def method(self, url, method="GET", parameters=None):
-        if parameters:
-            data = urlencode(parameters)
-        else:
-            data = None
+        # Connections are kept alive and reused, and responses gzipped
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers.update({'App-Key': appkey, 'Accept-Encoding': 'gzip'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._cache = {} # (url, parameters) -> (time, response)
+        self._cache_lock = threading.Lock()
+
+    def method(self, url, method="GET", parameters=None, cache=True):
+        # cache=False always fetches (and refreshes the cache), for live data
         method_url = urljoin(self.url, url)
-        if method == "GET" and data:
-            method_url = method_url+'?'+data
-            req = self.RequestWithMethod(method_url, http_method=method, data=None)
+        cacheable = method == "GET" and url.strip('/') in CACHED_ENDPOINTS
+        key = (method_url, tuple(sorted((parameters or {}).items())))
+
+        if cacheable and cache:
+            with self._cache_lock:
+                cached = self._cache.get(key)
+            if cached is not None and time.time() - cached[0] < self.cache_ttl:
+                return copy.deepcopy(cached[1])
+
+        if method == "GET":
+            response = self.session.request(method, method_url, params=parameters, timeout=self.timeout)
         else:
-            req = self.RequestWithMethod(method_url, http_method=method, data=data)
-        req.add_header('App-Key', self.appkey)
-        response = self.opener.open(req).read()
-        return json.loads(response)
-        
+            response = self.session.request(method, method_url, data=parameters, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+
+        with self._cache_lock:
+            if cacheable:
+                self._cache[key] = (time.time(), copy.deepcopy(result))
+            elif method != "GET":
+                # Something may have changed
+                self._cache.clear()
+        return result
+
     def check_by_name(self, name):
         resp = self.method('checks')
         checks = [check for check in resp['checks'] if check['name'] == name]
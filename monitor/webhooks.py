@@ -0,0 +1,281 @@
+import json
+import Queue
+import hashlib
+import logging
+import requests
+import threading
+from time import sleep, time
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from results import get_redis
+
+logger = logging.getLogger(__name__)
+
+ICON_URL = 'https://rawgithub.com/cloudwalkio/omg-monitor/slack-integration/docs/images/post_icon.png'
+
+# Events are dicts describing a monitor entering anomalous state:
+#   {'monitor': stream name, 'source': stream class name,
+#    'value_label': ..., 'value_unit': ..., 'chart': chart url,
+#    'report': {'anomaly_score': ..., 'likelihood': ...,
+#               'model_input': {'time': ..., 'value': ...}}}
+
+def _is_slack(webhook):
+    return "hooks.slack.com" in webhook
+
+def _slack_fields(event):
+    return [{'title': 'Chart',
+             'value':  event['chart'],
+             'short': False},
+            {'title': 'Metric',
+             'value': event['value_label'],
+             'short': True},
+            {'title': 'Value',
+             'value': str(event['report']['model_input']['value']) + ' ' + event['value_unit'],
+             'short': True}]
+
+def _generic_report(event):
+    return {'report': event['report'],
+            'monitor': event['monitor'],
+            'source': event['source'],
+            'metric': '%s (%s)' % (event['value_label'], event['value_unit']),
+            'chart': event['chart']}
+
+def build_payload(webhook, channel, event):
+    """ Return the payload to post one event: a Slack message if webhook is
+        from Slack, else a generic JSON.
+    """
+    if not _is_slack(webhook):
+        payload = _generic_report(event)
+        payload['sent_at'] = datetime.utcnow().isoformat()
+        return payload
+
+    payload = {'username': 'omg-monitor',
+               'icon_url': ICON_URL,
+               'text':  'Anomalous state in *%s* from _%s_:' % (event['monitor'], event['source']),
+               'attachments': [{'color': 'warning',
+                                'fields': _slack_fields(event)}]}
+    if channel is not None:
+        payload['channel'] = channel
+    return payload
+
+def build_digest_payload(webhook, channel, events, window):
+    """ Return the payload to post every event of a digest window at once. """
+
+    if not _is_slack(webhook):
+        return {'sent_at': datetime.utcnow().isoformat(),
+                'window': window,
+                'reports': [_generic_report(event) for event in events]}
+
+    attachments = []
+    for event in events:
+        fields = _slack_fields(event)
+        fields.extend([{'title': 'Anomaly score',
+                        'value': '%.5f' % event['report']['anomaly_score'],
+                        'short': True},
+                       {'title': 'Likelihood',
+                        'value': '%.5f' % event['report']['likelihood'],
+                        'short': True}])
+        attachments.append({'color': 'warning',
+                            'title': '%s from %s' % (event['monitor'], event['source']),
+                            'fields': fields})
+    payload = {'username': 'omg-monitor',
+               'icon_url': ICON_URL,
+               'text':  'Anomalous state in *%d* monitors in the last %d seconds:' % (len(events), window),
+               'attachments': attachments}
+    if channel is not None:
+        payload['channel'] = channel
+    return payload
+
+class WebhookDispatcher(object):
+    """ Post webhook payloads from a bounded queue in a background thread, so
+        that Monitor.update never waits for the network. Connections are reused
+        through a requests.Session and failed posts are retried with
+        exponential backoff.
+    """
+
+    def __init__(self, queue_size=100, timeout=10, retries=3, backoff=1):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = Queue.Queue(maxsize=queue_size)
+
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Counters: posts queued, sent, failed (after every retry), retried and
+        # dropped because the queue was full
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0}
+
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+    def post(self, url, payload, log=None):
+        """ Queue a JSON payload to be posted to url. Return False if dropped.
+            Results of the post are logged to log (defaults to this module's logger).
+        """
+        log = log or logger
+        try:
+            self.queue.put_nowait((url, payload, log))
+        except Queue.Full:
+            self.stats['dropped'] += 1
+            log.warn("Webhook queue is full, dropping post to %s. Stats: %s", url, self.stats)
+            return False
+        self.stats['queued'] += 1
+        return True
+
+    def join(self, timeout=None):
+        """ Wait until queued posts are done, for at most timeout seconds. """
+
+        deadline = None if timeout is None else time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time() > deadline:
+                logger.warn("%d webhook posts still queued.", self.queue.unfinished_tasks)
+                return False
+            sleep(0.1)
+        return True
+
+    def _run(self):
+        while True:
+            url, payload, log = self.queue.get()
+            try:
+                self._send(url, payload, log)
+            except Exception:
+                logger.warn("Unexpected error posting to %s.", url, exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def _send(self, url, payload, log):
+        """ Post payload, retrying on connection errors, 429 and 5xx responses. """
+
+        data = json.dumps(payload)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.stats['retried'] += 1
+                sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(url, data=data, timeout=self.timeout)
+            except requests.RequestException:
+                log.warn("Failed to post anomaly (attempt %d).", attempt + 1, exc_info=True)
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                log.warn("Anomaly post got status code %d (attempt %d): %s",
+                         response.status_code, attempt + 1, response.text)
+                continue
+
+            self.stats['sent'] += 1
+            log.info('Anomaly posted with status code %d: %s', response.status_code, response.text)
+            return
+
+        self.stats['failed'] += 1
+        log.warn("Giving up posting anomaly to %s. Stats: %s", url, self.stats)
+
+# Dispatcher shared by the monitors of the process (created on first use, so
+# that it's started after forking)
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    """ Return the WebhookDispatcher of the process. """
+
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = WebhookDispatcher()
+        return _dispatcher
+
+class Digest(object):
+    """ Collect events of every monitor of the host (across processes, through
+        Redis) and post one digest per webhook every window seconds.
+
+        Events are buffered in the process (so that Monitor.update never
+        waits for Redis) and pushed every second by a background thread to
+        'digest:<hash of webhook and channel>' lists. At the end of each
+        window every process with digests tries to take a lock for that
+        window, and the one that gets it posts the digest.
+    """
+
+    def __init__(self, window, db, max_pending=1000):
+        self.window = window
+        self.db = db
+        self.max_pending = max_pending
+        self.targets = {} # Digest key -> (webhook, channel)
+        self.pending = {} # Digest key -> events not pushed to Redis yet
+        self._lock = threading.Lock()
+
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+    def add(self, webhook, channel, event):
+        """ Add an event to the digest of webhook and channel. """
+
+        key = 'digest:%s' % hashlib.md5('%s %s' % (webhook, channel)).hexdigest()
+        with self._lock:
+            self.targets[key] = (webhook, channel)
+            events = self.pending.setdefault(key, [])
+            if len(events) >= self.max_pending:
+                logger.warn("Too many digest events waiting for Redis, dropping the oldest.")
+                del events[0]
+            events.append(event)
+
+    def _push(self):
+        """ Push buffered events to Redis, keeping them if it fails. """
+
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        for key, events in pending.items():
+            try:
+                self.db.rpush(key, *[json.dumps(event) for event in events])
+            except Exception:
+                logger.warn("Could not push %d digest events.", len(events), exc_info=True)
+                with self._lock:
+                    self.pending[key] = (events + self.pending.get(key, []))[-self.max_pending:]
+
+    def _run(self):
+        while True:
+            # Push events every second until the end of the current window
+            window_index = int(time() / self.window)
+            window_end = (window_index + 1) * self.window
+            while time() < window_end:
+                sleep(max(0, min(1, window_end - time())))
+                self._push()
+
+            with self._lock:
+                targets = self.targets.items()
+            for key, (webhook, channel) in targets:
+                try:
+                    self._post(key, webhook, channel, window_index)
+                except Exception:
+                    logger.warn("Could not post digest to %s.", webhook, exc_info=True)
+
+    def _post(self, key, webhook, channel, window_index):
+        # Only one process posts each window
+        lock = '%s:lock:%d' % (key, window_index)
+        if not self.db.set(lock, 1, ex=self.window * 10, nx=True):
+            return
+
+        pipe = self.db.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        events = [json.loads(e) for e in pipe.execute()[0]]
+        if events:
+            logger.info("Posting digest with %d events to %s.", len(events), webhook)
+            get_dispatcher().post(webhook, build_digest_payload(webhook, channel, events, self.window))
+
+# Digests of the process, by window and Redis settings
+_digests = {}
+
+def get_digest(window, redis_config=None):
+    """ Return the Digest of the process for window seconds. """
+
+    redis_config = redis_config or {}
+    key = (window, tuple(sorted(redis_config.items())))
+    with _dispatcher_lock:
+        if key not in _digests:
+            _digests[key] = Digest(window, get_redis(**redis_config))
+        return _digests[key]
@@ -4,8 +4,10 @@ import (
     "github.com/codegangsta/martini"
     "github.com/garyburd/redigo/redis"
     "net/http"
+    "encoding/binary"
     "encoding/json"
     "fmt"
+    "math"
     "strings"
     "strconv"
     "log"
@@ -29,6 +31,7 @@ type MonitorType struct {
 
 type Results struct {
     Results []ResultType `json:"results"`
+    Resolution int64 `json:"resolution"`
 }
 
 type ResultType struct {
@@ -40,14 +43,45 @@ type ResultType struct {
     Likelihood float64 `json:"likelihood"`
 }
 
+// Rollup of results over "resolution" seconds. The ResultType fields hold the
+// means of raw_value, transformed and predicted and the maximum of anomaly and
+// likelihood, so rollups can be plotted like results.
+type RollupType struct {
+    ResultType
+    Count int64 `json:"count"`
+    RawMin float64 `json:"raw_min"`
+    RawMax float64 `json:"raw_max"`
+    AnomalyMin float64 `json:"anomaly_min"`
+    AnomalyMean float64 `json:"anomaly_mean"`
+}
+
+type Rollups struct {
+    Results []RollupType `json:"results"`
+    Resolution int64 `json:"resolution"`
+}
+
+// Resolutions (in seconds) of the rollups saved by the monitors (see monitor/rollups.py)
+var rollupResolutions = []int64{300, 3600, 86400}
+
 const (
         maxConnections = 5
         connectTimeout = time.Duration(10) * time.Second
         readTimeout = time.Duration(10) * time.Second
         writeTimeout = time.Duration(10) * time.Second
-        server = "localhost:6379"
 )
 
+// Return the value of the environment variable key, or fallback if it's not set
+func getenv(key string, fallback string) string {
+    if value := os.Getenv(key); value != "" {
+        return value
+    }
+    return fallback
+}
+
+// Redis address and database, the same ones used by the monitors
+var server = getenv("REDIS_HOST", "localhost") + ":" + getenv("REDIS_PORT", "6379")
+var database = getenv("REDIS_DB", "0")
+
 var redisPool = redis.NewPool(func() (redis.Conn, error) {
         c, err := redis.DialTimeout("tcp", server, connectTimeout, readTimeout, writeTimeout)
         if err != nil {
@@ -55,6 +89,14 @@ var redisPool = redis.NewPool(func() (redis.Conn, error) {
             return nil, err
         }
 
+        if database != "0" {
+            if _, err := c.Do("SELECT", database); err != nil {
+                fmt.Printf("redis.NewPool err=%s\n", err)
+                c.Close()
+                return nil, err
+            }
+        }
+
         return c, err
 }, maxConnections)
 
@@ -110,32 +152,189 @@ func getJsonMonitors(redisResponse []interface{}) []byte {
     return b
 }
 
+// Binary results are fixed width records (see monitor/encoding.py):
+// magic byte, uint32 time, float64 raw_value, actual and predicted,
+// float32 anomaly and likelihood, all little endian.
+const (
+        binaryMagic = 0x01
+        binaryRecordSize = 37
+)
+
+// Decode one result saved in binary format
+func decodeBinaryResult(v []byte) ResultType {
+    le := binary.LittleEndian
+    return ResultType{
+        int64(le.Uint32(v[1:5])),
+        math.Float64frombits(le.Uint64(v[5:13])),
+        math.Float64frombits(le.Uint64(v[13:21])),
+        math.Float64frombits(le.Uint64(v[21:29])),
+        float64(math.Float32frombits(le.Uint32(v[29:33]))),
+        float64(math.Float32frombits(le.Uint32(v[33:37]))),
+    }
+}
+
+// Decode one result saved in CSV format
+func decodeCSVResult(v []byte) ResultType {
+    fields := strings.Split(string(v), ",")
+
+    // Set the fields that will compose the ResultType object
+    time, _ := strconv.ParseInt(fields[0], 10, 64)
+    rawValue, _ := strconv.ParseFloat(fields[1], 64)
+    actual, _ := strconv.ParseFloat(fields[2], 64)
+    predicted, _ := strconv.ParseFloat(fields[3], 64)
+    anomaly, _ := strconv.ParseFloat(fields[4], 64)
+    likelihood, _ := strconv.ParseFloat(fields[5], 64)
+
+    return ResultType{time, rawValue, actual, predicted, anomaly, likelihood}
+}
+
+// Decode one result saved in any format (both can be in the same list)
+func decodeResult(v []byte) ResultType {
+    if len(v) == binaryRecordSize && v[0] == binaryMagic {
+        return decodeBinaryResult(v)
+    }
+    return decodeCSVResult(v)
+}
+
 // Return a JSON with the results
 func getJsonResults(redisResponse []interface{}) []byte {
     results := make([]ResultType, len(redisResponse))
 
     for k, _ := range redisResponse {
-        // oneResult holds one line of the list of results
+        // v holds one line of the list of results
+        var v []byte
+        redisResponse, _ = redis.Scan(redisResponse, &v)
+
+        results[k] = decodeResult(v)
+    }
+
+    b,_ := json.MarshalIndent(Results{results, 0}, "", "  ")
+    return b
+}
+
+// Return a JSON with the rollups
+func getJsonRollups(redisResponse []interface{}, resolution int64) []byte {
+    rollups := make([]RollupType, len(redisResponse))
+
+    for k, _ := range redisResponse {
         v := ""
         redisResponse, _ = redis.Scan(redisResponse, &v)
 
+        // Fields: time, count, raw_min, raw_max, raw_mean, actual_mean, predicted_mean,
+        // anomaly_min, anomaly_max, anomaly_mean, likelihood_max
         fields := strings.Split(v, ",")
-
-        // Set the fields that will compose the ResultType object
+        values := make([]float64, len(fields))
+        for i := 2; i < len(fields); i++ {
+            values[i], _ = strconv.ParseFloat(fields[i], 64)
+        }
         time, _ := strconv.ParseInt(fields[0], 10, 64)
-        rawValue, _ := strconv.ParseFloat(fields[1], 64)
-        actual, _ := strconv.ParseFloat(fields[2], 64)
-        predicted, _ := strconv.ParseFloat(fields[3], 64)
-        anomaly, _ := strconv.ParseFloat(fields[4], 64)
-        likelihood, _ := strconv.ParseFloat(fields[5], 64)
+        count, _ := strconv.ParseInt(fields[1], 10, 64)
 
-        results[k] = ResultType{time, rawValue, actual, predicted, anomaly, likelihood}
+        rollups[k] = RollupType{ResultType{time, values[4], values[5], values[6], values[8], values[10]},
+                                count, values[2], values[3], values[7], values[9]}
     }
 
-    b,_ := json.MarshalIndent(Results{results}, "", "  ")
+    b,_ := json.MarshalIndent(Rollups{rollups, resolution}, "", "  ")
     return b
 }
 
+// Pick the resolution to answer a query from "from" to "to" (now, if empty) with
+// at most "points" rows: 0 (raw results) if they cover the range with no more
+// than "points" rows, else the finest rollup with no more than "points" buckets.
+func pickResolution(conn redis.Conn, check_id string, from string, to string, points int64) (int64, error) {
+    key := "results:" + check_id
+    start, _ := strconv.ParseInt(from, 10, 64)
+    end := time.Now().Unix()
+    if to != "" {
+        end, _ = strconv.ParseInt(to, 10, 64)
+    }
+
+    // Results saved as lists can't be counted by time, so use them
+    keyType, err := redis.String(conn.Do("TYPE", key))
+    if err != nil || keyType == "list" {
+        return 0, err
+    }
+
+    oldest, err := redis.Values(conn.Do("ZRANGE", key, 0, 0, "WITHSCORES"))
+    if err != nil {
+        return 0, err
+    }
+    if len(oldest) == 2 {
+        oldestTime, _ := redis.Int64(oldest[1], nil)
+        count, err := redis.Int64(conn.Do("ZCOUNT", key, start, end))
+        if err != nil {
+            return 0, err
+        }
+        if oldestTime <= start && count <= points {
+            return 0, nil
+        }
+    }
+
+    for _, resolution := range rollupResolutions {
+        if (end - start) / resolution <= points {
+            return resolution, nil
+        }
+    }
+    return rollupResolutions[len(rollupResolutions) - 1], nil
+}
+
+// Return the last "limit" results (all, if limit is 0) saved in key with time
+// between from and to (both optional). Results are saved in a sorted set scored
+// by time, so this is O(log n + k), or in a list (older versions), in which
+// case the range is filtered after reading the last "limit" results.
+func queryResults(conn redis.Conn, key string, from string, to string, limit int64) ([]interface{}, error) {
+    keyType, err := redis.String(conn.Do("TYPE", key))
+    if err != nil {
+        return nil, err
+    }
+
+    if keyType == "list" {
+        reply, err := redis.Values(conn.Do("LRANGE", key, -limit, -1))
+        if err != nil || (from == "" && to == "") {
+            return reply, err
+        }
+        return filterResults(reply, from, to), nil
+    }
+
+    if from == "" {
+        from = "-inf"
+    }
+    if to == "" {
+        to = "+inf"
+    }
+
+    if from == "-inf" && to == "+inf" {
+        return redis.Values(conn.Do("ZRANGE", key, -limit, -1))
+    }
+    if limit <= 0 {
+        return redis.Values(conn.Do("ZRANGEBYSCORE", key, from, to))
+    }
+
+    // Last "limit" in the range, in reverse, so put them back in time order
+    reply, err := redis.Values(conn.Do("ZREVRANGEBYSCORE", key, to, from, "LIMIT", 0, limit))
+    for i, j := 0, len(reply) - 1; i < j; i, j = i + 1, j - 1 {
+        reply[i], reply[j] = reply[j], reply[i]
+    }
+    return reply, err
+}
+
+// Keep only results with time between from and to (both optional)
+func filterResults(redisResponse []interface{}, from string, to string) []interface{} {
+    start, errf := strconv.ParseInt(from, 10, 64)
+    end, errt := strconv.ParseInt(to, 10, 64)
+
+    filtered := make([]interface{}, 0, len(redisResponse))
+    for _, value := range redisResponse {
+        v, _ := redis.Bytes(value, nil)
+        t := decodeResult(v).Time
+        if (errf == nil && t < start) || (errt == nil && t > end) {
+            continue
+        }
+        filtered = append(filtered, value)
+    }
+    return filtered
+}
+
 func main() {
     flag.Parse()
 
@@ -151,19 +350,63 @@ func main() {
             return http.StatusUnauthorized , "Not authorized"
         }
 
+        // Optional time range (unix timestamps) of the results
+        from := req.URL.Query().Get("from")
+        to := req.URL.Query().Get("to")
+        for _, t := range []string{from, to} {
+            if _, err := strconv.ParseInt(t, 10, 64); t != "" && err != nil {
+                return http.StatusBadRequest, "Invalid time range"
+            }
+        }
+
         conn := redisPool.Get()
 
         // Parse the url to get the query paramenter named "limit" and convert to int
         limit, _ := strconv.ParseInt(req.URL.Query().Get("limit"),10, 64)
 
-        // Query redis for the last "limit" results for the given "check_id"
-        reply, err := redis.Values(conn.Do("LRANGE", "results:" + params["check_id"], -limit, -1))
+        // Resolution of the results: 0 for raw results or one of rollupResolutions.
+        // If not given, it's picked for the time range to give at most "points" rows.
+        resolution, errr := strconv.ParseInt(req.URL.Query().Get("resolution"), 10, 64)
+        if errr != nil && from != "" {
+            points, errp := strconv.ParseInt(req.URL.Query().Get("points"), 10, 64)
+            if errp != nil {
+                points = 1440
+            }
+            resolution, errr = pickResolution(conn, params["check_id"], from, to, points)
+            for {
+                if errr == nil {
+                    break;
+                    } else {
+                        log.Printf("Redis error in pick resolution: %s\n", errr)
+                        resolution, errr = pickResolution(conn, params["check_id"], from, to, points)
+                    }
+            }
+        }
+
+        if resolution > 0 {
+            // Query redis for the rollups in the range for the given "check_id"
+            key := "rollup:" + strconv.FormatInt(resolution, 10) + ":" + params["check_id"]
+            reply, err := queryResults(conn, key, from, to, limit)
+            for {
+                if err == nil {
+                    break;
+                    } else {
+                        log.Printf("Redis error in query rollups: %s\n", err)
+                        reply, err = queryResults(conn, key, from, to, limit)
+                    }
+            }
+            conn.Close()
+            return http.StatusOK, string(getJsonRollups(reply, resolution))
+        }
+
+        // Query redis for the last "limit" results in the range for the given "check_id"
+        reply, err := queryResults(conn, "results:" + params["check_id"], from, to, limit)
         for {
             if err == nil {
                 break;
                 } else {
-                    log.Printf("Redis error in LRANGE results: %s\n", err)
-                    reply, err = redis.Values(conn.Do("LRANGE", "results:" + params["check_id"], -limit, -1))
+                    log.Printf("Redis error in query results: %s\n", err)
+                    reply, err = queryResults(conn, "results:" + params["check_id"], from, to, limit)
                 }
         }
         conn.Close()
@@ -3,6 +3,16 @@
 # Create logs dir
 mkdir -p $LOG_DIR
 
+# Create checkpoints dir
+if [ -n "$CHECKPOINT_DIR" ]; then
+    mkdir -p $CHECKPOINT_DIR
+fi
+
+# Create cache dir
+if [ -n "$CACHE_DIR" ]; then
+    mkdir -p $CACHE_DIR
+fi
+
 # Initialize access token to empty string
 SERVER_TOKEN=
 
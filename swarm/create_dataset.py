@@ -24,30 +24,41 @@
 
 from datetime import datetime
 from collections import deque
+import os
 import sys
 import csv
 from time import strftime, gmtime, sleep
 
 from utils import pingdom # Pingdom API wrapper
+from streams.cache import PointCache # Cache shared with the monitors
 
 _UTC_OFFSET = 10800 # Time zone offset (-3:00 GMT for Sao Paulo/Brazil)
 _TIMEOUT = 60000 # Default response time when status is not 'up' (ms)
 _SECONDS_PER_REQUEST = 60 # Sleep time between requests (in seconds)
 
-def create_dataset(check_id, username, password, appkey):
+def create_dataset(check_id, username, password, appkey, cache_dir=None):
     # Pingdom instance
     ping = pingdom.Pingdom(username=username, password=password, appkey=appkey)
 
+    # Results cached by the monitors (or by previous runs) aren't fetched again
+    cache = PointCache(cache_dir, 'PingdomStream', check_id) if cache_dir else None
+    last_cached = cache.last_time() if cache else None
 
-    print "[%s] Getting last 5000 results" % check_id
+    if last_cached is None:
+        print "[%s] Getting last 6000 results" % check_id
+    else:
+        print "[%s] Getting results newer than the cached ones" % check_id
     sys.stdout.flush()
 
     # Get past resuts for check
     results = deque()
     i = 0
     while i < 6:
+        parameters = {'limit': 1000, 'offset': i*1000}
+        if last_cached is not None:
+            parameters['from'] = last_cached + 1
         try:
-            pingdomResult = ping.method('results/%d/' % check_id, method='GET', parameters={'limit': 1000, 'offset': i*1000})
+            pingdomResult = ping.method('results/%d/' % check_id, method='GET', parameters=parameters)
         except Exception, e:
             print "[%s] Could not get Pingdom results." % check_id
             print e
@@ -56,6 +67,12 @@ def create_dataset(check_id, username, password, appkey):
         for result in pingdomResult['results']:
             results.appendleft(result)
         i = i + 1
+        if len(pingdomResult['results']) < 1000:
+            break
+
+    if cache is not None:
+        cache.add(list(results), 'time')
+        results = cache.points()[-6000:]
 
     servertime = None
     with open('swarm/dataset.csv', 'wb') as csvfile:
@@ -111,15 +128,18 @@ def create_dataset(check_id, username, password, appkey):
 
 if __name__ == "__main__":
     if(len(sys.argv) <= 4):
-        print "Usage: create_dataset.py [username] [password] [appkey] [CHECK_ID]"
+        print "Usage: create_dataset.py [username] [password] [appkey] [CHECK_ID] [CACHE_DIR]"
         sys.exit(0)
 
     # If 4 arguments passed, set check_id
-    if(len(sys.argv) == 5):
+    if(len(sys.argv) >= 5):
         username = sys.argv[1]
         password = sys.argv[2]
         appkey = sys.argv[3]
         check_id = int(sys.argv[4])
 
+    # Cache dir defaults to CACHE_DIR environment variable
+    cache_dir = sys.argv[5] if len(sys.argv) >= 6 else os.environ.get('CACHE_DIR')
+
     # Create dataset
-    create_dataset(check_id, username, password, appkey)
\ No newline at end of file
+    create_dataset(check_id, username, password, appkey, cache_dir)
\ No newline at end of file